@@ -0,0 +1,179 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+import uuid
+
+# run from the directory that holds etc/unicenta2moneybird.conf, the lib package lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from lib import staging  # noqa: E402
+
+parser = argparse.ArgumentParser(description='Fill a uniCenta database with synthetic sales for benchmarking.')
+parser.add_argument('--lines', dest='lines', type=int, default=10000, help="Number of ticketlines to generate "
+                                                                           "(10000 to 5000000)")
+parser.add_argument('--days', dest='days', type=int, default=30, help="Spread the sales over this many days, "
+                                                                      "ending today")
+parser.add_argument('--target', dest='target', choices=['mysql', 'sqlite'], required=True,
+                    help="mysql fills the uniCenta database from the config, sqlite fills the staging database")
+parser.add_argument('--database', dest='database', type=str, help="The sqlite staging database to fill, "
+                                                                  "default is the one from the config")
+parser.add_argument('--seed', dest='seed', type=int, default=1, help="Random seed, the same seed gives the same data")
+
+# the uniCenta tables, with only the columns unicenta2moneybird uses
+mysql_schema = [
+    'CREATE TABLE IF NOT EXISTS taxes (id VARCHAR(255) PRIMARY KEY, name VARCHAR(255), category VARCHAR(255), '
+    'rate DOUBLE)',
+    'CREATE TABLE IF NOT EXISTS receipts (id VARCHAR(255) PRIMARY KEY, money VARCHAR(255), datenew DATETIME, '
+    'INDEX receipts_datenew (datenew))',
+    'CREATE TABLE IF NOT EXISTS tickets (id VARCHAR(255) PRIMARY KEY, tickettype INT, ticketid INT, '
+    'person VARCHAR(255), status INT)',
+    'CREATE TABLE IF NOT EXISTS ticketlines (ticket VARCHAR(255), line INT, product VARCHAR(255), units DOUBLE, '
+    'price DOUBLE, taxid VARCHAR(255), attributes MEDIUMTEXT, PRIMARY KEY (ticket, line))',
+    'CREATE TABLE IF NOT EXISTS payments (id VARCHAR(255) PRIMARY KEY, receipt VARCHAR(255), payment VARCHAR(255), '
+    'total DOUBLE, transid VARCHAR(255), INDEX payments_receipt (receipt))',
+]
+
+taxes = [
+    {'id': '001', 'name': 'Hoog', 'category': '001', 'rate': 0.21},
+    {'id': '002', 'name': 'Laag', 'category': '002', 'rate': 0.09},
+    {'id': '000', 'name': 'Geen', 'category': '000', 'rate': 0.0},
+]
+
+attributes_format = '<?xml version="1.0" encoding="UTF-8" standalone="no"?><properties>' \
+                    '<entry key="product.taxcategoryid">{0}</entry><entry key="product.name">{1}</entry>' \
+                    '<entry key="product.printer">1</entry></properties>'
+
+
+def MakeCatalog(rnd, size=60):
+    catalog = []
+    for number in range(size):
+        tax = rnd.choice(taxes)
+        catalog.append({
+            'id': 'product-{0}'.format(number),
+            'price_incl_cents': rnd.randint(50, 5000),
+            'tax': tax,
+            'attributes': attributes_format.format(tax['category'], "Product {0}".format(number))
+        })
+    return catalog
+
+
+def GenerateSales(lines, days, seed):
+    """Yield (receipt, ticket, ticketlines, payments) until the requested number of ticketlines is reached"""
+    rnd = random.Random(seed)
+    catalog = MakeCatalog(rnd)
+    end = datetime.datetime.now().replace(microsecond=0)
+    start = end - datetime.timedelta(days=days)
+    seconds_per_line = (days * 86400) / max(lines, 1)
+
+    generated = 0
+    ticketid = 0
+    while generated < lines:
+        ticketid += 1
+        receiptid = str(uuid.UUID(int=rnd.getrandbits(128)))
+        datenew = start + datetime.timedelta(seconds=int(generated * seconds_per_line))
+        ticketlines = []
+        total_cents = 0
+        for line in range(min(rnd.randint(1, 5), lines - generated)):
+            product = rnd.choice(catalog)
+            units = rnd.randint(1, 3)
+            ticketlines.append({
+                'ticket': receiptid,
+                'line': line,
+                'product': product['id'],
+                'units': float(units),
+                'price': product['price_incl_cents'] / 100 / (1 + product['tax']['rate']),
+                'taxid': product['tax']['id'],
+                'attributes': product['attributes']
+            })
+            total_cents += product['price_incl_cents'] * units
+        generated += len(ticketlines)
+
+        receipt = {'id': receiptid, 'money': 'bench', 'datenew': datenew}
+        ticket = {'id': receiptid, 'tickettype': 0, 'ticketid': ticketid, 'person': '0', 'status': 0}
+        payments = [{
+            'id': str(uuid.UUID(int=rnd.getrandbits(128))),
+            'receipt': receiptid,
+            'payment': 'cash',
+            'total': total_cents / 100,
+            'transid': None
+        }]
+        yield receipt, ticket, ticketlines, payments
+
+
+def FillMySQL(lines, days, seed, batch_size=1000):
+    from lib import uc
+    connection = uc.GetDBConnection()
+    cursor = connection.cursor()
+    for statement in mysql_schema:
+        cursor.execute(statement)
+    # the sales go straight into the uniCenta tables, so only ever fill a database without sales of its own
+    cursor.execute('SELECT COUNT(*) FROM receipts')
+    if cursor.fetchone()[0] > 0:
+        print("The receipts table of {0} is not empty, refusing to add synthetic sales to it. Use an empty, "
+              "disposable database for the benchmark.".format(uc.Unicenta_MySQL_db))
+        exit(1)
+    cursor.executemany('REPLACE INTO taxes (id, name, category, rate) VALUES (%s, %s, %s, %s)',
+                       [(tax['id'], tax['name'], tax['category'], tax['rate']) for tax in taxes])
+
+    batches = {'receipts': [], 'tickets': [], 'ticketlines': [], 'payments': []}
+    statements = {
+        'receipts': 'INSERT INTO receipts (id, money, datenew) VALUES (%(id)s, %(money)s, %(datenew)s)',
+        'tickets': 'INSERT INTO tickets (id, tickettype, ticketid, person, status) '
+                   'VALUES (%(id)s, %(tickettype)s, %(ticketid)s, %(person)s, %(status)s)',
+        'ticketlines': 'INSERT INTO ticketlines (ticket, line, product, units, price, taxid, attributes) '
+                       'VALUES (%(ticket)s, %(line)s, %(product)s, %(units)s, %(price)s, %(taxid)s, %(attributes)s)',
+        'payments': 'INSERT INTO payments (id, receipt, payment, total, transid) '
+                    'VALUES (%(id)s, %(receipt)s, %(payment)s, %(total)s, %(transid)s)',
+    }
+
+    def Flush():
+        for table in ['receipts', 'tickets', 'ticketlines', 'payments']:
+            if len(batches[table]) > 0:
+                cursor.executemany(statements[table], batches[table])
+                batches[table] = []
+        connection.commit()
+
+    for receipt, ticket, ticketlines, payments in GenerateSales(lines, days, seed):
+        batches['receipts'].append(receipt)
+        batches['tickets'].append(ticket)
+        batches['ticketlines'].extend(ticketlines)
+        batches['payments'].extend(payments)
+        if len(batches['ticketlines']) >= batch_size:
+            Flush()
+    Flush()
+    cursor.close()
+
+
+def FillSQLite(lines, days, seed, database):
+    if database is not None:
+        staging.staging_database = database
+
+    def Rows(table):
+        for receipt, ticket, ticketlines, payments in GenerateSales(lines, days, seed):
+            if table == 'receipts':
+                yield receipt
+            elif table == 'tickets':
+                yield ticket
+            elif table == 'ticketlines':
+                for ticketline in ticketlines:
+                    yield ticketline
+            else:
+                for payment in payments:
+                    yield payment
+
+    staging.UpsertRecords('taxes', taxes)
+    for table in ['receipts', 'tickets', 'ticketlines', 'payments']:
+        staging.UpsertRecords(table, Rows(table), default=lambda obj: obj.isoformat())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    started = datetime.datetime.now()
+    if args.target == 'mysql':
+        FillMySQL(args.lines, args.days, args.seed)
+    else:
+        FillSQLite(args.lines, args.days, args.seed, args.database)
+    print("Generated {0} ticketlines over {1} days into {2} in {3}".format(args.lines, args.days, args.target,
+                                                                          datetime.datetime.now() - started))
@@ -0,0 +1,269 @@
+import argparse
+import collections
+import datetime
+import http.server
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+
+parser = argparse.ArgumentParser(description='Local stand-in for the Moneybird endpoints unicenta2moneybird uses.')
+parser.add_argument('--port', dest='port', type=int, default=8765, help="Port to listen on")
+parser.add_argument('--latency', dest='latency', type=float, default=0.0, help="Seconds to wait before every answer")
+parser.add_argument('--rate-limit', dest='rate_limit', type=int, default=0, help="Requests allowed per period, "
+                                                                                "0 is unlimited")
+parser.add_argument('--rate-period', dest='rate_period', type=float, default=300.0, help="Rate limit period in "
+                                                                                         "seconds")
+
+# the names the benchmark config refers to
+contact_passant = 'Passant'
+financial_account_unicenta_cash = 'Pos Kassa'
+grootboekrekening_omzet = 'Omzet'
+
+
+class MoneybirdState:
+    """The administration of the stand-in, kept in memory. Every record gets a numeric id and a version that is
+       raised on every change, like the real api does.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=0, rate_period=300.0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000)
+        self.tokens = float(rate_limit)
+        self.token_time = time.monotonic()
+        self.requests = collections.Counter()
+
+        self.contacts = [{'id': '1', 'company_name': contact_passant, 'version': 1}]
+        self.financial_accounts = [{'id': '2', 'name': financial_account_unicenta_cash, 'version': 1}]
+        self.ledger_accounts = [{'id': '3', 'name': grootboekrekening_omzet, 'version': 1}]
+        self.tax_rates = []
+        for tax_rate_type in ['sales_invoice', 'purchase_invoice']:
+            for name, percentage in [('21% btw', '21.0'), ('9% btw', '9.0'), ('Geen btw', None)]:
+                self.tax_rates.append({'id': str(next(self.ids)), 'name': name, 'percentage': percentage,
+                                       'tax_rate_type': tax_rate_type})
+        self.sales_invoices = collections.OrderedDict()
+        self.financial_mutations = collections.OrderedDict()
+
+    def NextId(self):
+        return str(next(self.ids))
+
+    def TakeToken(self):
+        """Return 0 when the request may go through, otherwise the seconds until the next token"""
+        if self.rate_limit <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate_limit),
+                              self.tokens + (now - self.token_time) * self.rate_limit / self.rate_period)
+            self.token_time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) * self.rate_period / self.rate_limit
+
+    def CountRequest(self, method, endpoint, status):
+        with self.lock:
+            self.requests["{0} {1} {2}".format(method, endpoint, status)] += 1
+
+    def GetStatistics(self):
+        with self.lock:
+            return dict(self.requests)
+
+
+def ParsePeriod(query):
+    """Return the (start, end) dates of a 'period:YYYYMMDD..YYYYMMDD' filter, or None"""
+    for value in query.get('filter', []):
+        match = re.match(r'period:(\d{8})\.\.(\d{8})', value)
+        if match:
+            return match.group(1), match.group(2)
+    return None
+
+
+def InPeriod(date, period):
+    if period is None:
+        return True
+    day = date[:10].replace('-', '')
+    return period[0] <= day <= period[1]
+
+
+def Paged(items, query):
+    page = int(query.get('page', ['1'])[0])
+    per_page = int(query.get('per_page', ['100'])[0])
+    return items[(page - 1) * per_page:page * per_page]
+
+
+class MoneybirdHandler(http.server.BaseHTTPRequestHandler):
+    state = None
+    routes = [
+        ('GET', 'contacts', r'contacts\.json'),
+        ('GET', 'financial_accounts', r'financial_accounts\.json'),
+        ('GET', 'ledger_accounts', r'ledger_accounts\.json'),
+        ('GET', 'tax_rates', r'tax_rates\.json'),
+        ('GET', 'financial_mutations/synchronization', r'financial_mutations/synchronization\.json'),
+        ('POST', 'financial_mutations/synchronization', r'financial_mutations/synchronization\.json'),
+        ('GET', 'sales_invoices/synchronization', r'sales_invoices/synchronization\.json'),
+        ('POST', 'sales_invoices/synchronization', r'sales_invoices/synchronization\.json'),
+        ('GET', 'documents/purchase_invoices', r'documents/purchase_invoices\.json'),
+        ('POST', 'sales_invoices', r'sales_invoices(\.json)?'),
+        ('PATCH', 'sales_invoices/send_invoice', r'sales_invoices/(\w+)/send_invoice\.json'),
+        ('POST', 'financial_statements', r'financial_statements\.json'),
+        ('PATCH', 'financial_mutations/link_booking', r'financial_mutations/(\w+)/link_booking\.json'),
+    ]
+
+    def log_message(self, format, *args):
+        # keep the benchmark output clean
+        pass
+
+    def do_GET(self):
+        self.Handle('GET')
+
+    def do_POST(self):
+        self.Handle('POST')
+
+    def do_PATCH(self):
+        self.Handle('PATCH')
+
+    def Answer(self, method, endpoint, status, body=None, headers=None):
+        self.state.CountRequest(method, endpoint, status)
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def Handle(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+
+        # the path is /api/v2/<administratie_id>/<endpoint>
+        match = re.match(r'^/api/v2/[^/]+/(.*)$', url.path)
+        route = None
+        if match:
+            for route_method, endpoint, pattern in self.routes:
+                route_match = re.fullmatch(pattern, match.group(1))
+                if route_method == method and route_match:
+                    route = (endpoint, route_match)
+                    break
+        if route is None:
+            self.Answer(method, url.path, 404, {'error': 'Not found'})
+            return
+        endpoint, route_match = route
+
+        if self.state.latency > 0:
+            time.sleep(self.state.latency)
+        wait = self.state.TakeToken()
+        if wait > 0:
+            self.Answer(method, endpoint, 429, {'error': 'Too many requests'},
+                        {'Retry-After': str(max(1, int(wait + 0.999)))})
+            return
+
+        status, answer = getattr(self, 'Handle_' + endpoint.replace('/', '_'))(query, body, route_match)
+        self.Answer(method, endpoint, status, answer)
+
+    def Handle_contacts(self, query, body, route_match):
+        return 200, Paged(self.state.contacts, query)
+
+    def Handle_financial_accounts(self, query, body, route_match):
+        return 200, self.state.financial_accounts
+
+    def Handle_ledger_accounts(self, query, body, route_match):
+        return 200, self.state.ledger_accounts
+
+    def Handle_tax_rates(self, query, body, route_match):
+        return 200, Paged(self.state.tax_rates, query)
+
+    def Handle_documents_purchase_invoices(self, query, body, route_match):
+        return 200, []
+
+    def Synchronization(self, records, date_field, query, body):
+        with self.state.lock:
+            if body is None:
+                period = ParsePeriod(query)
+                return 200, [{'id': record['id'], 'version': record['version']} for record in records.values()
+                             if InPeriod(record[date_field], period)]
+            return 200, [records[record_id] for record_id in body.get('ids', []) if record_id in records]
+
+    def Handle_financial_mutations_synchronization(self, query, body, route_match):
+        return self.Synchronization(self.state.financial_mutations, 'date', query, body)
+
+    def Handle_sales_invoices_synchronization(self, query, body, route_match):
+        return self.Synchronization(self.state.sales_invoices, 'invoice_date', query, body)
+
+    def Handle_sales_invoices(self, query, body, route_match):
+        invoice = dict(body['sales_invoice'])
+        invoice['id'] = self.state.NextId()
+        invoice['invoice_date'] = invoice['invoice_date'][:10]
+        invoice['state'] = 'draft'
+        invoice['version'] = int(time.time() * 1000)
+        invoice['details'] = invoice.pop('details_attributes')
+        with self.state.lock:
+            self.state.sales_invoices[invoice['id']] = invoice
+        return 201, invoice
+
+    def Handle_sales_invoices_send_invoice(self, query, body, route_match):
+        with self.state.lock:
+            invoice = self.state.sales_invoices.get(route_match.group(1))
+            if invoice is None:
+                return 404, {'error': 'Not found'}
+            invoice['state'] = 'open'
+            invoice['version'] += 1
+            return 200, dict(invoice)
+
+    def Handle_financial_statements(self, query, body, route_match):
+        statement = body['financial_statement']
+        mutations = []
+        with self.state.lock:
+            for attributes in statement['financial_mutations_attributes'].values():
+                mutation = {
+                    'id': self.state.NextId(),
+                    'financial_account_id': statement['financial_account_id'],
+                    'date': attributes['date'][:10],
+                    'message': attributes['message'],
+                    'amount': "{0:.2f}".format(float(attributes['amount'])),
+                    'payments': [],
+                    'ledger_account_bookings': [],
+                    'version': int(time.time() * 1000)
+                }
+                self.state.financial_mutations[mutation['id']] = mutation
+                mutations.append(dict(mutation))
+        return 201, {'id': self.state.NextId(), 'reference': statement['reference'],
+                     'financial_mutations': mutations}
+
+    def Handle_financial_mutations_link_booking(self, query, body, route_match):
+        with self.state.lock:
+            mutation = self.state.financial_mutations.get(route_match.group(1))
+            if mutation is None:
+                return 404, {'error': 'Not found'}
+            mutation['payments'].append({'id': self.state.NextId(), 'invoice_type': body['booking_type'],
+                                         'invoice_id': body['booking_id'], 'price': body['price_base'],
+                                         'payment_date': datetime.date.today().isoformat()})
+            mutation['version'] += 1
+            return 200, dict(mutation)
+
+
+def MakeServer(port=0, latency=0.0, rate_limit=0, rate_period=300.0):
+    """Return a server on localhost with a fresh administration, port 0 picks a free port"""
+    handler = type('Handler', (MoneybirdHandler,), {'state': MoneybirdState(latency, rate_limit, rate_period)})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = MakeServer(args.port, args.latency, args.rate_limit, args.rate_period)
+    print("Moneybird stand-in listening on http://127.0.0.1:{0}/api/v2".format(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.RequestHandlerClass.state.GetStatistics(), indent=4, sort_keys=True))
@@ -0,0 +1,191 @@
+import argparse
+import configparser
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import moneybird_stub
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+parser = argparse.ArgumentParser(description='Time every phase of unicenta2moneybird against synthetic data and the '
+                                             'local Moneybird stand-in.')
+parser.add_argument('--conf', dest='conf', type=str,
+                    help="Config with the [Unicenta] section of the (local, disposable!) benchmark database, never "
+                         "the config of a live shop. Required with --source mysql")
+parser.add_argument('--source', dest='source', choices=['mysql', 'sqlite'], default='mysql',
+                    help="mysql generates into the benchmark database and times a whole run, sqlite generates into "
+                         "the staging database of the working directory and only times the transform")
+parser.add_argument('--lines', dest='lines', type=int, default=10000, help="Number of ticketlines to generate")
+parser.add_argument('--days', dest='days', type=int, default=30, help="Spread the sales over this many days")
+parser.add_argument('--seed', dest='seed', type=int, default=1, help="Random seed of the generator")
+parser.add_argument('--skip-generate', dest='skip_generate', action='store_true', help="Use the data that is "
+                                                                                       "already in the database")
+parser.add_argument('--staging', dest='staging', choices=['json', 'sqlite'], default='json',
+                    help="Staging mode of the run")
+parser.add_argument('--latency', dest='latency', type=float, default=0.0, help="Latency of the Moneybird stand-in")
+parser.add_argument('--rate-limit', dest='rate_limit', type=int, default=0, help="Requests per period the stand-in "
+                                                                                "allows, 0 is unlimited")
+parser.add_argument('--rate-period', dest='rate_period', type=float, default=300.0, help="Rate limit period")
+parser.add_argument('--report', dest='report', type=str, help="Where to write the json report, default is "
+                                                              "bench/reports/<timestamp>.json")
+parser.add_argument('--compare', dest='compare', type=str, help="A previous report to compare the phases with")
+
+phase_pattern = re.compile(r'Phase (\S+) finished in ([0-9.]+)s')
+
+# the transform of the generated sales on its own, run from the working directory
+transform_snippet = '''
+import datetime, time
+from lib import uc
+started = time.monotonic()
+uc.TransformSales(datetime.datetime.now() - datetime.timedelta(days={days} + 1), datetime.datetime.now())
+print('Phase transform finished in {{0:.3f}}s'.format(time.monotonic() - started))
+'''
+
+
+def MakeWorkdir(args, api_url):
+    """Create a working directory with its own etc/, var/ and log/, so a run starts with empty stores"""
+    workdir = tempfile.mkdtemp(prefix='unicenta2moneybird-bench-')
+    for directory in ['etc', 'var', 'log']:
+        os.makedirs(os.path.join(workdir, directory))
+
+    config = configparser.ConfigParser()
+    config['Global'] = {'default_days_back': str(args.days), 'staging': args.staging}
+    if args.source == 'sqlite':
+        # the sales are read from the staging database, the uniCenta database is never opened
+        config['Global']['staging'] = 'sqlite'
+        config['Unicenta'] = {'Unicenta_MySQL_host': '', 'Unicenta_MySQL_user': '', 'Unicenta_MySQL_pass': '',
+                              'Unicenta_MySQL_db': ''}
+    else:
+        source = configparser.ConfigParser()
+        if len(source.read(args.conf)) == 0:
+            print("Could not read config {0}".format(args.conf))
+            exit(1)
+        config['Unicenta'] = dict(source['Unicenta'])
+        config['Unicenta'].pop('payment_method_filter', None)
+    config['Moneybird'] = {
+        'token': 'benchmark',
+        'administratie_id': 'benchmark',
+        'api_url': api_url,
+        'contact_passant': moneybird_stub.contact_passant,
+        'financial_account_unicenta_cash': moneybird_stub.financial_account_unicenta_cash,
+        'grootboekrekening_omzet': moneybird_stub.grootboekrekening_omzet,
+    }
+    # the limiter of the run must match the stand-in, with the production bucket we would only time the waiting
+    if args.rate_limit > 0:
+        config['Moneybird']['rate_limit_requests'] = str(args.rate_limit)
+        config['Moneybird']['rate_limit_period'] = str(args.rate_period)
+    else:
+        config['Moneybird']['rate_limit_requests'] = '1000000'
+        config['Moneybird']['rate_limit_period'] = '1'
+    with open(os.path.join(workdir, 'etc', 'unicenta2moneybird.conf'), 'w') as configfile:
+        config.write(configfile)
+    return workdir
+
+
+def RunBenchmark(args):
+    server = moneybird_stub.MakeServer(0, args.latency, args.rate_limit, args.rate_period)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = "http://127.0.0.1:{0}/api/v2".format(server.server_address[1])
+    workdir = MakeWorkdir(args, api_url)
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': GetRevision(),
+        'parameters': GetParameters(args),
+        'phases': {},
+    }
+
+    if not args.skip_generate:
+        started = time.monotonic()
+        subprocess.run([sys.executable, os.path.join(repository, 'bench', 'generate_unicenta.py'), '--target',
+                        args.source, '--lines', str(args.lines), '--days', str(args.days), '--seed', str(args.seed)],
+                       cwd=workdir, check=True)
+        report['generate_seconds'] = round(time.monotonic() - started, 3)
+
+    started = time.monotonic()
+    if args.source == 'sqlite':
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = repository
+        run = subprocess.run([sys.executable, '-c', transform_snippet.format(days=args.days)], cwd=workdir,
+                             env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    else:
+        startdate = (datetime.date.today() - datetime.timedelta(days=args.days)).strftime("%d%m%Y")
+        run = subprocess.run([sys.executable, os.path.join(repository, 'unicenta2moneybird.py'), '-v', '--full',
+                              '--startdate', startdate], cwd=workdir, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, universal_newlines=True)
+    report['total_seconds'] = round(time.monotonic() - started, 3)
+    report['exit_code'] = run.returncode
+    for match in phase_pattern.finditer(run.stdout):
+        report['phases'][match.group(1)] = float(match.group(2))
+    report['api_calls'] = server.RequestHandlerClass.state.GetStatistics()
+    report['workdir'] = workdir
+    server.shutdown()
+
+    if run.returncode != 0:
+        print(run.stdout)
+    return report
+
+
+def GetParameters(args):
+    return {'source': args.source, 'lines': args.lines, 'days': args.days, 'seed': args.seed,
+            'staging': args.staging, 'latency': args.latency, 'rate_limit': args.rate_limit,
+            'rate_period': args.rate_period}
+
+
+def GetRevision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def PrintReport(report, previous=None):
+    print("Benchmark of {0} ticketlines, revision {1}".format(report['parameters']['lines'], report['revision']))
+    rows = list(report['phases'].items()) + [('total', report['total_seconds'])]
+    for phase, seconds in rows:
+        line = "  {0:<12} {1:>10.2f}s".format(phase, seconds)
+        if previous is not None:
+            before = previous['total_seconds'] if phase == 'total' else previous['phases'].get(phase)
+            if before:
+                line += "  {0:>10.2f}s  {1:+.1f}%".format(before, (seconds - before) / before * 100)
+        print(line)
+    for call, count in sorted(report['api_calls'].items()):
+        print("  {0:<60} {1:>8}".format(call, count))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.source == 'mysql' and args.conf is None:
+        parser.error("--conf is required with --source mysql")
+    if args.source == 'sqlite' and args.skip_generate:
+        parser.error("--source sqlite generates into a fresh working directory, it can not skip the generation")
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as json_file:
+            previous = json.load(json_file)
+        if previous['parameters'] != GetParameters(args):
+            print("Warning: {0} was made with other parameters: {1}".format(args.compare, previous['parameters']))
+
+    report = RunBenchmark(args)
+
+    reportfile = args.report
+    if reportfile is None:
+        os.makedirs(os.path.join(repository, 'bench', 'reports'), exist_ok=True)
+        reportfile = os.path.join(repository, 'bench', 'reports', '{0}.json'.format(
+            report['timestamp'].replace(':', '')))
+    with open(reportfile, 'w') as outfile:
+        json.dump(report, outfile, indent=4, sort_keys=True)
+
+    PrintReport(report, previous)
+    print("Report written to {0}".format(reportfile))
+    if report['exit_code'] != 0:
+        exit(report['exit_code'])
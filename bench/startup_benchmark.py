@@ -0,0 +1,57 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+parser = argparse.ArgumentParser(description='Measure the cold start of unicenta2moneybird: the time from starting '
+                                             'python to importing the modules and to the first uniCenta query, '
+                                             'as a frequently polling cron job pays it.')
+parser.add_argument('--runs', dest='runs', type=int, default=10, help="Number of cold starts to measure")
+parser.add_argument('--query', dest='query', action='store_true', help="Also run the first query of an "
+                                                                       "incremental run, this needs the uniCenta "
+                                                                       "database from the config")
+parser.add_argument('--modules', dest='modules', type=str, default='uc,mb,cache,metrics,scheduler,staging',
+                    help="The lib modules the main script imports")
+
+# runs in a fresh interpreter for every measurement, from the directory with etc/unicenta2moneybird.conf
+snippet = '''
+import json, sys, time
+started = time.perf_counter()
+from lib import {modules}
+imported = time.perf_counter()
+if {query}:
+    uc.GetLatestReceipt()
+queried = time.perf_counter()
+heavy = [module for module in ('numpy', 'requests', 'mysql.connector') if module in sys.modules]
+print(json.dumps({{'import': imported - started, 'first_query': queried - started, 'heavy': heavy}}))
+'''
+
+
+def MeasureStartup(modules, query):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = repository
+    started = time.perf_counter()
+    run = subprocess.run([sys.executable, '-c', snippet.format(modules=', '.join(modules), query=query)],
+                         env=environment, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    result = json.loads(run.stdout.splitlines()[-1])
+    result['process'] = time.perf_counter() - started
+    return result
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    modules = [module.strip() for module in args.modules.split(',') if module.strip()]
+    results = [MeasureStartup(modules, args.query) for _ in range(args.runs)]
+
+    print("Cold start over {0} runs (median, min):".format(args.runs))
+    for measure, description in [('import', 'import lib modules'),
+                                 ('first_query', 'import to first query'),
+                                 ('process', 'whole process')]:
+        values = [result[measure] * 1000 for result in results]
+        print("  {0:<24} {1:>8.1f}ms {2:>8.1f}ms".format(description, statistics.median(values), min(values)))
+    print("  heavy modules loaded: {0}".format(', '.join(results[-1]['heavy']) or 'none'))
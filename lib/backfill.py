@@ -0,0 +1,73 @@
+import datetime
+import json
+import logging
+import os
+
+from lib import profiles
+
+config = profiles.ReadConfig()
+
+# the size of a backfill partition: month, week, day or a number of days
+backfill_partition = config.get('Global', 'backfill_partition', fallback='month').strip()
+
+checkpointfile = profiles.VarPath('backfill_checkpoint.json')
+
+
+def GetPartitions(startDate, endDate, partition=None):
+    """Split a date window into a list of (start, end) partitions. Months follow the calendar, so the partitions
+       only depend on the first start date, and a resumed backfill with a later end date finds the same ones.
+    """
+    if partition is None:
+        partition = backfill_partition
+    if partition not in ('month', 'week', 'day'):
+        try:
+            days = int(partition)
+        except ValueError:
+            days = 0
+        if days < 1:
+            logging.error("Can not use backfill partition '{0}', use month, week, day or a number of "
+                          "days".format(partition))
+            exit(1)
+    elif partition == 'week':
+        days = 7
+    elif partition == 'day':
+        days = 1
+
+    partitions = []
+    start = startDate
+    while start < endDate:
+        if partition == 'month':
+            end = datetime.datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+        else:
+            end = datetime.datetime(start.year, start.month, start.day) + datetime.timedelta(days=days)
+        end = min(end, endDate)
+        partitions.append((start, end))
+        start = end
+    return partitions
+
+
+def LoadCheckpoint():
+    """Return the set of (start, end) partitions, as iso strings, that an earlier backfill completed"""
+    try:
+        with open(checkpointfile) as json_file:
+            return set(tuple(partition) for partition in json.load(json_file)['completed'])
+    except FileNotFoundError:
+        return set()
+
+
+def SaveCheckpoint(completed):
+    # write to a temporary file first, so an interrupted backfill never leaves a broken checkpoint behind
+    with open(checkpointfile + '.tmp', 'w') as outfile:
+        json.dump({'completed': sorted(list(partition) for partition in completed)}, outfile, indent=4)
+    os.replace(checkpointfile + '.tmp', checkpointfile)
+
+
+def ClearCheckpoint():
+    try:
+        os.remove(checkpointfile)
+    except FileNotFoundError:
+        pass
+
+
+def PartitionKey(partition):
+    return partition[0].isoformat(), partition[1].isoformat()
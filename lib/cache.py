@@ -0,0 +1,38 @@
+import json
+import logging
+
+# parsed contents of the json stores in var/, keyed by file name
+_snapshots = {}
+
+hits = 0
+misses = 0
+
+
+def Load(filename):
+    """Return the parsed contents of a json store, reading the file only on the first call"""
+    global hits, misses
+    if filename in _snapshots:
+        hits += 1
+        return _snapshots[filename]
+    misses += 1
+    with open(filename) as json_file:
+        if filename.endswith('.ndjson'):
+            data = [json.loads(line) for line in json_file if line.strip()]
+        else:
+            data = json.load(json_file)
+    _snapshots[filename] = data
+    return data
+
+
+def Replace(filename, data):
+    """Use data as the snapshot for a store that was just written with exactly this content"""
+    _snapshots[filename] = data
+
+
+def Invalidate(filename):
+    """Forget the snapshot of a store, so the next Load reads the file again"""
+    _snapshots.pop(filename, None)
+
+
+def LogStatistics():
+    logging.info("Snapshot cache: {0} hits, {1} misses ({2} stores loaded)".format(hits, misses, len(_snapshots)))
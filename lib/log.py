@@ -2,6 +2,8 @@ import logging
 import sys
 import os
 
+from lib import profiles
+
 
 def logger(flagVerbose):
     logger = logging.getLogger("")
@@ -9,7 +11,7 @@ def logger(flagVerbose):
 
     # Create handlers
     c_handler = logging.StreamHandler(sys.stdout)
-    f_handler = logging.FileHandler(os.path.join('log', 'unicenta2moneybird.log'))
+    f_handler = logging.FileHandler(profiles.Suffixed(os.path.join('log', 'unicenta2moneybird.log')))
     if flagVerbose:
         c_handler.setLevel(logging.INFO)
     else:
@@ -17,7 +19,11 @@ def logger(flagVerbose):
     f_handler.setLevel(logging.DEBUG)
 
     # Create formatters and add it to handlers
-    c_format = logging.Formatter('%(message)s')
+    if profiles.name is None:
+        c_format = logging.Formatter('%(message)s')
+    else:
+        # the profiles share the console of the parent process
+        c_format = logging.Formatter('[{0}] %(message)s'.format(profiles.name))
     f_format = logging.Formatter('%(asctime)s %(levelname)s - %(message)s')
     c_handler.setFormatter(c_format)
     f_handler.setFormatter(f_format)
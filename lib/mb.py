@@ -1,86 +1,191 @@
-import configparser
+import collections
+import concurrent.futures
+import decimal
+import email.utils
 import json
 import logging
-import math
 import os
-import numpy
-import requests
+import threading
+import time
+
+from lib import cache, metrics, profiles, staging
 
 # default verbosity, will be overwritten by main class
 flagVerbose = False
 flagNoop = False
 
-config = configparser.ConfigParser()
-config.read('etc/unicenta2moneybird.conf')
+config = profiles.ReadConfig()
 
 tokenMoneyBird = config['Moneybird']['Token']
 administratie_id = config['Moneybird']['administratie_id']
-
-store_contacts = os.path.join("var", 'moneybird_contacts.json')
-store_financial_accounts = os.path.join("var", 'moneybird_financial_accounts.json')
-store_ledger_accounts = os.path.join("var", 'moneybird_ledger_accounts.json')
-store_financial_mutations_sync = os.path.join("var", 'moneybird_financial_mutations_sync.json')
-store_financial_mutations = os.path.join("var", 'moneybird_financial_mutations.json')
-store_sales_invoices = os.path.join("var", 'moneybird_sales_invoices.json')
-store_purchase_invoices = os.path.join("var", 'moneybird_purchase_invoices.json')
-store_tax_rates = os.path.join("var", 'moneybird_tax_rates.json')
+api_url = config.get('Moneybird', 'api_url', fallback='https://moneybird.com/api/v2').rstrip('/')
+
+# settings for the shared http session
+http_pool_size = int(config.get('Moneybird', 'http_pool_size', fallback='10'))
+http_timeout = float(config.get('Moneybird', 'http_timeout', fallback='30'))
+http_gzip = config.getboolean('Moneybird', 'http_gzip', fallback=True)
+download_workers = int(config.get('Moneybird', 'download_workers', fallback='4'))
+write_workers = int(config.get('Moneybird', 'write_workers', fallback='4'))
+statement_batch_size = int(config.get('Moneybird', 'statement_batch_size', fallback='100'))
+
+# the Moneybird api allows rate_limit_requests calls per rate_limit_period seconds
+rate_limit_requests = int(config.get('Moneybird', 'rate_limit_requests', fallback='150'))
+rate_limit_period = float(config.get('Moneybird', 'rate_limit_period', fallback='300'))
+rate_limit_retries = int(config.get('Moneybird', 'rate_limit_retries', fallback='5'))
+
+_Session = None
+_HTTPAdapter = None
+# the threads that start the first downloads all ask for the session at once, only one of them creates it
+_SessionLock = threading.Lock()
+# counted by ourselves, urllib3 counts a dropped connection it opens again as the same connection
+_HTTPStatisticsLock = threading.Lock()
+_HTTPRequests = 0
+_HTTPConnectionsOpened = 0
+
+# token bucket shared by all threads that call the api
+_RateLimitLock = threading.Lock()
+_RateLimitTokens = float(rate_limit_requests)
+_RateLimitUpdated = time.monotonic()
+# after a throttled answer nobody calls the api before this time, not only the thread that got the answer
+_RateLimitBlockedUntil = 0.0
+throttle_wait_seconds = 0.0
+throttle_retries = 0
+
+store_contacts = profiles.VarPath('moneybird_contacts.json')
+store_financial_accounts = profiles.VarPath('moneybird_financial_accounts.json')
+store_ledger_accounts = profiles.VarPath('moneybird_ledger_accounts.json')
+store_financial_mutations_sync = profiles.VarPath('moneybird_financial_mutations_sync.json')
+store_financial_mutations = profiles.VarPath('moneybird_financial_mutations.json')
+store_sales_invoices = profiles.VarPath('moneybird_sales_invoices.json')
+store_purchase_invoices = profiles.VarPath('moneybird_purchase_invoices.json')
+store_tax_rates = profiles.VarPath('moneybird_tax_rates.json')
+store_financial_mutations_versions = profiles.VarPath('moneybird_financial_mutations_versions.json')
+store_sales_invoices_versions = profiles.VarPath('moneybird_sales_invoices_versions.json')
+
+# reconciliation indexes, built on first use and kept up to date when we create invoices and statements
+_sales_invoices_by_reference = None
+_financial_mutations_by_message = None
+_unlinked_financial_mutations = None
+
+# name -> id indexes of the reference data, per store, built on first use and dropped when the store is downloaded
+_lookup_indexes = {}
+_tax_rate_index = None
+
+# the ids of the contact, ledger account and financial account named in the config, see ResolveConfiguredIds
+configured_ids = None
+
+# records we created or changed through the api, merged into the local stores until FlushStores writes them
+_StoreLock = threading.Lock()
+_dirty_stores = set()
+_store_versions = {
+    store_financial_mutations: store_financial_mutations_versions,
+    store_sales_invoices: store_sales_invoices_versions
+}
+# the tables that replace these stores when the sqlite staging database is enabled
+_staging_tables = {
+    store_financial_mutations: 'financial_mutations',
+    store_sales_invoices: 'sales_invoices'
+}
+
+
+def GetLookupIndex(store, name_field):
+    """Return a dict of name -> id for a reference data store"""
+    index = _lookup_indexes.get(store)
+    if index is None:
+        index = {}
+        for item in cache.Load(store):
+            index.setdefault(item[name_field], item['id'])
+        _lookup_indexes[store] = index
+    return index
 
 
 def LookupContactId(company_name):
-    with open(store_contacts) as json_file:
-        data = json.load(json_file)
-    for contact in data:
-        if contact['company_name'] == company_name:
-            return contact['id']
+    contact_id = GetLookupIndex(store_contacts, 'company_name').get(company_name)
+    if contact_id is not None:
+        return contact_id
     logging.error("Could not lookup contact with name '{0}' (watch out, case sensitive!)".format(company_name))
     exit(1)
 
 
 def LookupLedgerAccountId(name):
-    with open(store_ledger_accounts) as json_file:
-        data = json.load(json_file)
-    for ledger_account in data:
-        if ledger_account['name'] == name:
-            return ledger_account['id']
+    ledger_account_id = GetLookupIndex(store_ledger_accounts, 'name').get(name)
+    if ledger_account_id is not None:
+        return ledger_account_id
     logging.error("Could not lookup ledger account with name '{0}' (watch out, case sensitive!)".format(name))
     exit(1)
 
 
 def LookupFinancialAccountId(name):
-    with open(store_financial_accounts) as json_file:
-        data = json.load(json_file)
-    for financial_account in data:
-        if financial_account['name'] == name:
-            return financial_account['id']
+    financial_account_id = GetLookupIndex(store_financial_accounts, 'name').get(name)
+    if financial_account_id is not None:
+        return financial_account_id
     logging.error("Could not lookup financial account with name '{0}' (watch out, case sensitive!)".format(name))
     exit(1)
 
 
+def NormalizePercentage(percentage):
+    """Round a tax percentage, so 21.000000000000004 and "21.0" end up as the same key"""
+    return round(float(percentage), 4)
+
+
+def GetTaxRateIndex():
+    """Return a dict of (tax_rate_type, normalized percentage) -> tax rate id"""
+    global _tax_rate_index
+    if _tax_rate_index is None:
+        # built aside and published whole, the invoice threads must never see a half filled index
+        index = {}
+        for tax_rate in cache.Load(store_tax_rates):
+            if tax_rate['name'] == "Geen btw":
+                # a percentage of zero always means 'Geen btw'
+                index[(tax_rate["tax_rate_type"], 0.0)] = tax_rate['id']
+        for tax_rate in cache.Load(store_tax_rates):
+            if tax_rate['percentage'] is not None:
+                try:
+                    key = (tax_rate["tax_rate_type"], NormalizePercentage(tax_rate['percentage']))
+                except ValueError:
+                    logging.exception("There was a problem reading tax rate percentage '{0}' from json.".format(
+                        tax_rate['percentage']))
+                    continue
+                index.setdefault(key, tax_rate['id'])
+        _tax_rate_index = index
+    return _tax_rate_index
+
+
 def LookupTaxrateId(tax_rate_type, percentage):
     try:
-        percentage = float(percentage)
+        percentage = NormalizePercentage(percentage)
     except:
         logging.error("Can not convert value '{0}' to float".format(percentage))
 
-    with open(store_tax_rates) as json_file:
-        data = json.load(json_file)
-    for tax_rate in data:
-
-        if tax_rate["tax_rate_type"] == tax_rate_type:
-            if percentage == 0.0:
-                if tax_rate['name'] == "Geen btw":
-                    return tax_rate['id']
-            if tax_rate['percentage'] is not None:
-                try:
-                    if numericEqual(float(tax_rate['percentage']), percentage):
-                        return tax_rate['id']
-                except:
-                    logging.exception("There was a problem comparing tax rate percentage '{0}' with value {1} from json.".format(percentage, tax_rate['percentage']))
+    tax_rate_id = GetTaxRateIndex().get((tax_rate_type, percentage))
+    if tax_rate_id is not None:
+        return tax_rate_id
 
     logging.error("Could not lookup tax rate with percentage '{0}' (watch out, case sensitive!)".format(percentage))
     exit(1)
 
 
+def ResolveConfiguredIds():
+    """Look up the ids of the contact, ledger account and financial account that are named in the config once,
+       and build the tax rate index, before the invoices are sent from a thread pool
+    """
+    global configured_ids
+    GetTaxRateIndex()
+    configured_ids = {
+        'contact_passant': LookupContactId(config['Moneybird']['contact_passant']),
+        'grootboekrekening_omzet': LookupLedgerAccountId(config['Moneybird']['grootboekrekening_omzet']),
+        'financial_account_unicenta_cash': LookupFinancialAccountId(
+            config['Moneybird']['financial_account_unicenta_cash'])
+    }
+    return configured_ids
+
+
+def GetConfiguredIds():
+    if configured_ids is None:
+        return ResolveConfiguredIds()
+    return configured_ids
+
+
 def LookupTaxrateIdPurchase(percentage):
     return LookupTaxrateId("purchase_invoice", percentage)
     #
@@ -121,58 +226,159 @@ def LookupTaxrateIdSales(percentage):
 
 
 def DownloadContacts():
-    contacts = []
-    per_page = 100
-    count = 1
-    continueloop = True
-    while continueloop:
-        url = "https://moneybird.com/api/v2/{0}/contacts.json?page={1}&per_page={2}".format(administratie_id, count,
-                                                                                            per_page)
-        o = MakeGetRequest(url)
-        for contact in o:
-            contacts.append(contact)
-        if len(o) < per_page:
-            continueloop = False
-        count = count + 1
+    url = api_url + "/{0}/contacts.json".format(administratie_id)
+    contacts = MakePagedGetRequest(url)
 
     with open(store_contacts, 'w') as outfile:
         json.dump(contacts, outfile, indent=4, sort_keys=True)
+    cache.Replace(store_contacts, contacts)
+    metrics.Add('rows_read', len(contacts))
+    metrics.AddStagedFile(store_contacts)
+    _lookup_indexes.pop(store_contacts, None)
     logging.info('Downloaded Moneybird contacts ({0} items)'.format(len(contacts)))
 
 
 def DownloadFinancialAccounts():
-    url = "https://moneybird.com/api/v2/{0}/financial_accounts.json".format(administratie_id)
+    url = api_url + "/{0}/financial_accounts.json".format(administratie_id)
     o = MakeGetRequest(url)
 
     with open(store_financial_accounts, 'w') as outfile:
         json.dump(o, outfile, indent=4, sort_keys=True)
+    cache.Replace(store_financial_accounts, o)
+    metrics.Add('rows_read', len(o))
+    metrics.AddStagedFile(store_financial_accounts)
+    _lookup_indexes.pop(store_financial_accounts, None)
     logging.info('Downloaded Moneybird financial accounts ({0} items)'.format(len(o)))
 
 
 def DownloadLedgerAccounts():
-    url = "https://moneybird.com/api/v2/{0}/ledger_accounts.json".format(administratie_id)
+    url = api_url + "/{0}/ledger_accounts.json".format(administratie_id)
     o = MakeGetRequest(url)
 
     with open(store_ledger_accounts, 'w') as outfile:
         json.dump(o, outfile, indent=4, sort_keys=True)
+    cache.Replace(store_ledger_accounts, o)
+    metrics.Add('rows_read', len(o))
+    metrics.AddStagedFile(store_ledger_accounts)
+    _lookup_indexes.pop(store_ledger_accounts, None)
     logging.info('Downloaded Moneybird ledger accounts ({0} items)'.format(len(o)))
 
 
 def DownloadTaxRates():
-    url = "https://moneybird.com/api/v2/{0}/tax_rates.json".format(administratie_id)
+    url = api_url + "/{0}/tax_rates.json".format(administratie_id)
     o = MakeGetRequest(url)
 
     with open(store_tax_rates, 'w') as outfile:
         json.dump(o, outfile, indent=4, sort_keys=True)
+    cache.Replace(store_tax_rates, o)
+    metrics.Add('rows_read', len(o))
+    metrics.AddStagedFile(store_tax_rates)
+    global _tax_rate_index
+    _tax_rate_index = None
     logging.info('Downloaded Moneybird tax rates ({0} items)'.format(len(o)))
 
 
+def SynchronizeStore(sync_list, synchronization_url, store, store_versions):
+    """Bring a local store up to date with a synchronization list of ids and versions from Moneybird.
+       Only records that are new or have a different version than our local id -> version map are
+       fetched, the others are taken from the local store. Returns the number of records in the sync list.
+    """
+    if staging.enabled:
+        local_versions = staging.GetVersions(_staging_tables[store])
+        local_records = None
+    else:
+        try:
+            with open(store_versions) as json_file:
+                local_versions = json.load(json_file)
+            local_records = {}
+            for record in cache.Load(store):
+                local_records[record['id']] = record
+        except FileNotFoundError:
+            local_versions = {}
+            local_records = {}
+
+    changed_ids = []
+    for item in sync_list:
+        if local_versions.get(str(item['id'])) != item['version'] or \
+                (local_records is not None and item['id'] not in local_records):
+            changed_ids.append(item['id'])
+
+    fetched_records = {}
+    if len(changed_ids) > 0:
+        # we can only download up to a 100 records at once, so split up into chunks
+        for start in range(0, len(changed_ids), 100):
+            chunk = changed_ids[start:start + 100]
+            postObj = {"ids": [str(id) for id in chunk]}
+            o = MakePostRequest(synchronization_url, postObj)
+            for record in o:
+                fetched_records[record['id']] = record
+    metrics.Add('rows_read', len(sync_list) + len(fetched_records))
+
+    if staging.enabled:
+        staging.UpsertRecords(_staging_tables[store], fetched_records.values())
+        logging.info('Synchronized {0}: {1} changed, {2} unchanged'.format(
+            _staging_tables[store], len(fetched_records), len(sync_list) - len(fetched_records)))
+        return len(sync_list)
+
+    records = []
+    versions = {}
+    for item in sync_list:
+        record = fetched_records.get(item['id'], local_records.get(item['id']))
+        if record is not None:
+            records.append(record)
+            versions[str(item['id'])] = record['version']
+
+    with open(store, 'w') as outfile:
+        json.dump(records, outfile, indent=4, sort_keys=True)
+    cache.Replace(store, records)
+    metrics.AddStagedFile(store)
+    with open(store_versions, 'w') as outfile:
+        json.dump(versions, outfile, indent=4, sort_keys=True)
+    logging.info('Synchronized {0}: {1} changed, {2} unchanged'.format(os.path.basename(store), len(fetched_records),
+                                                                       len(records) - len(fetched_records)))
+    return len(records)
+
+
+def MergeIntoStore(store, record):
+    """Add a record returned by the api to a local store, replacing an older version of it on FlushStores"""
+    if staging.enabled:
+        staging.UpsertRecords(_staging_tables[store], [record])
+        return
+    with _StoreLock:
+        cache.Load(store).append(record)
+        _dirty_stores.add(store)
+
+
+def FlushStores():
+    """Write the stores that got records merged into them, keeping only the newest version of every record"""
+    with _StoreLock:
+        for store in _dirty_stores:
+            newest = {}
+            for record in cache.Load(store):
+                newest[record['id']] = record
+            records = []
+            versions = {}
+            for record in cache.Load(store):
+                if record['id'] not in versions:
+                    records.append(newest[record['id']])
+                    versions[str(record['id'])] = newest[record['id']]['version']
+
+            with open(store, 'w') as outfile:
+                json.dump(records, outfile, indent=4, sort_keys=True)
+            cache.Replace(store, records)
+            metrics.AddStagedFile(store)
+            with open(_store_versions[store], 'w') as outfile:
+                json.dump(versions, outfile, indent=4, sort_keys=True)
+            logging.info('Saved {0} ({1} items)'.format(os.path.basename(store), len(records)))
+        _dirty_stores.clear()
+
+
 def DownloadFinanancialMutations(startdate, enddate):
     startdatestring = startdate.strftime("%Y%m%d")
     enddatestring = enddate.strftime("%Y%m%d")
 
-    # First, get a list of all id's
-    url = "https://moneybird.com/api/v2/{0}/financial_mutations/synchronization.json?filter=period%3A{1}..{2}".format(
+    # First, get a list of all id's and their versions
+    url = api_url + "/{0}/financial_mutations/synchronization.json?filter=period%3A{1}..{2}".format(
         administratie_id, startdatestring, enddatestring)
     o = MakeGetRequest(url)
 
@@ -180,116 +386,175 @@ def DownloadFinanancialMutations(startdate, enddate):
         json.dump(o, outfile, indent=4, sort_keys=True)
     logging.info('Downloaded Moneybird financial mutations sync ({0} items)'.format(len(o)))
 
-    # store result
-    financial_mutations = []
-
-    if len(o) > 0:
-        # we can only download up to a 100 mutations at once. See how many requests we need
-        number_of_splits = math.ceil(len(o) / 100)
-        # split up into chunks
-        chunks = numpy.array_split(o, number_of_splits)
-
-        for chunk in chunks:
-            idlistforthischunk = []
-            for item in chunk:
-                idlistforthischunk.append(item['id'])
-            postObj = {"ids": idlistforthischunk}
-            url = "https://moneybird.com/api/v2/{0}/financial_mutations/synchronization.json".format(administratie_id)
-            o = MakePostRequest(url, postObj)
-            for financial_mutation in o:
-                financial_mutations.append(financial_mutation)
+    # then only fetch the mutations that are new or changed
+    url = api_url + "/{0}/financial_mutations/synchronization.json".format(administratie_id)
+    count = SynchronizeStore(o, url, store_financial_mutations, store_financial_mutations_versions)
 
-    with open(store_financial_mutations, 'w') as outfile:
-        json.dump(financial_mutations, outfile, indent=4, sort_keys=True)
-    logging.info('Downloaded Moneybird financial mutations ({0} items)'.format(len(financial_mutations)))
+    global _financial_mutations_by_message, _unlinked_financial_mutations
+    _financial_mutations_by_message = None
+    _unlinked_financial_mutations = None
+    logging.info('Downloaded Moneybird financial mutations ({0} items)'.format(count))
 
 
 def DownloadSalesInvoices(startdate, enddate):
     startdatestring = startdate.strftime("%Y%m%d")
     enddatestring = enddate.strftime("%Y%m%d")
-    salesinvoices = []
-    per_page = 100
-    count = 1
-    continueloop = True
-    while continueloop:
-        url = "https://moneybird.com/api/v2/{0}/sales_invoices.json?filter=period%3A{1}..{2}&page={3}&per_page={4}".format(
-            administratie_id, startdatestring, enddatestring, count, per_page)
-        o = MakeGetRequest(url)
-        for salesinvoice in o:
-            salesinvoices.append(salesinvoice)
-        if len(o) < per_page:
-            continueloop = False
-        count = count + 1
-
-    with open(store_sales_invoices, 'w') as outfile:
-        json.dump(salesinvoices, outfile, indent=4, sort_keys=True)
-    logging.info('Downloaded Moneybird sales invoices ({0} items)'.format(len(salesinvoices)))
+
+    # First, get a list of all id's and their versions, then only fetch the invoices that are new or changed
+    url = api_url + "/{0}/sales_invoices/synchronization.json?filter=period%3A{1}..{2}".format(
+        administratie_id, startdatestring, enddatestring)
+    o = MakeGetRequest(url)
+    url = api_url + "/{0}/sales_invoices/synchronization.json".format(administratie_id)
+    count = SynchronizeStore(o, url, store_sales_invoices, store_sales_invoices_versions)
+
+    global _sales_invoices_by_reference
+    _sales_invoices_by_reference = None
+    logging.info('Downloaded Moneybird sales invoices ({0} items)'.format(count))
 
 
 def GetSalesInvoices():
-    with open(store_sales_invoices) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('sales_invoices'))
+    return cache.Load(store_sales_invoices)
 
 
 def GetPurchaseInvoices():
-    with open(store_purchase_invoices) as json_file:
-        data = json.load(json_file)
-    return data
+    return cache.Load(store_purchase_invoices)
 
 
 def GetFinancialMutations():
-    with open(store_financial_mutations) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('financial_mutations'))
+    return cache.Load(store_financial_mutations)
+
+
+def GetSalesInvoicesByReference():
+    """Return a dict of reference -> sales invoice"""
+    if staging.enabled:
+        return staging.KeyedTable('sales_invoices', 'reference')
+    global _sales_invoices_by_reference
+    if _sales_invoices_by_reference is None:
+        _sales_invoices_by_reference = {}
+        for salesinvoice in GetSalesInvoices():
+            _sales_invoices_by_reference[salesinvoice['reference']] = salesinvoice
+    return _sales_invoices_by_reference
+
+
+def GetFinancialMutationsByMessage():
+    """Return a dict of message -> list of financial mutations, a sale paid in parts has one mutation per payment"""
+    if staging.enabled:
+        return staging.KeyedTable('financial_mutations', 'message', many=True)
+    global _financial_mutations_by_message, _unlinked_financial_mutations
+    if _financial_mutations_by_message is None:
+        _financial_mutations_by_message = {}
+        _unlinked_financial_mutations = {}
+        for financial_mutation in GetFinancialMutations():
+            _financial_mutations_by_message.setdefault(financial_mutation['message'], []).append(financial_mutation)
+            if len(financial_mutation['payments']) == 0:
+                _unlinked_financial_mutations[financial_mutation['id']] = financial_mutation
+    return _financial_mutations_by_message
+
+
+def GetUnlinkedFinancialMutations():
+    """Return the financial mutations that have no payments linked to them yet"""
+    if staging.enabled:
+        return list(staging.GetRecords('financial_mutations', 'WHERE unlinked = 1'))
+    GetFinancialMutationsByMessage()
+    return list(_unlinked_financial_mutations.values())
 
 
 def DownloadPurchaseInvoices(startdate, enddate):
     startdatestring = startdate.strftime("%Y%m%d")
     enddatestring = enddate.strftime("%Y%m%d")
-    purchaseinvoices = []
-    per_page = 100
-    count = 1
-    continueloop = True
-    while continueloop:
-        url = "https://moneybird.com/api/v2/{0}/documents/purchase_invoices.json?filter=period%3A{1}..{2}&page={3}&per_page={4}".format(
-            administratie_id, startdatestring, enddatestring, count, per_page)
-        o = MakeGetRequest(url)
-        for purchaseinvoice in o:
-            purchaseinvoices.append(purchaseinvoice)
-        if len(o) < per_page:
-            continueloop = False
-        count = count + 1
+    url = api_url + "/{0}/documents/purchase_invoices.json?filter=period%3A{1}..{2}".format(
+        administratie_id, startdatestring, enddatestring)
+    purchaseinvoices = MakePagedGetRequest(url)
 
     with open(store_purchase_invoices, 'w') as outfile:
         json.dump(purchaseinvoices, outfile, indent=4, sort_keys=True)
+    cache.Replace(store_purchase_invoices, purchaseinvoices)
+    metrics.Add('rows_read', len(purchaseinvoices))
+    metrics.AddStagedFile(store_purchase_invoices)
     logging.info('Downloaded Moneybird purchase invoices ({0} items)'.format(len(purchaseinvoices)))
 
 
 def AddFinancialStatementAndMutation(reference, timestamp, amount_dec):
-    financial_account_unicenta_cash = LookupFinancialAccountId(config['Moneybird']['financial_account_unicenta_cash'])
+    return AddFinancialStatementWithMutations(reference, [(reference, timestamp, amount_dec)])[0]
+
+
+def AddFinancialStatementWithMutations(reference, mutations):
+    """Post one financial statement holding many mutations, a list of (message, timestamp, amount_dec).
+       Returns the ids of the created mutations, in the same order as the mutations.
+    """
+    financial_account_unicenta_cash = GetConfiguredIds()['financial_account_unicenta_cash']
+
+    financial_mutations_attributes = {}
+    for number, (message, timestamp, amount_dec) in enumerate(mutations, start=1):
+        financial_mutations_attributes[str(number)] = {
+            "date": timestamp.strftime('%Y-%m-%d'),
+            "message": message,
+            "amount": "{0:f}".format(amount_dec)}
 
     statement = {
         "financial_statement":
             {
                 "reference": reference,
                 "financial_account_id": financial_account_unicenta_cash,
-                "financial_mutations_attributes":
-                    {
-                        "1": {
-                            "date": timestamp.strftime('%Y-%m-%d'),
-                            "message": reference,
-                            "amount": "{0:f}".format(amount_dec)}
-                    }
+                "financial_mutations_attributes": financial_mutations_attributes
             }
     }
 
-    url = "https://moneybird.com/api/v2/{0}/financial_statements.json".format(administratie_id)
+    url = api_url + "/{0}/financial_statements.json".format(administratie_id)
 
     statementpost = MakePostRequest(url, statement)
-    financial_mutation_id = statementpost['financial_mutations'][0]['id']
 
-    return financial_mutation_id
+    # match the created mutations to ours on message, date and amount, the api does not promise to keep the order
+    created = {}
+    for financial_mutation in statementpost['financial_mutations']:
+        key = (financial_mutation['message'], financial_mutation['date'],
+               decimal.Decimal(financial_mutation['amount']))
+        created.setdefault(key, []).append(financial_mutation)
+        MergeIntoStore(store_financial_mutations, financial_mutation)
+
+    financial_mutation_ids = []
+    for position, (message, timestamp, amount_dec) in enumerate(mutations):
+        matches = created.get((message, timestamp.strftime('%Y-%m-%d'), decimal.Decimal("{0:f}".format(amount_dec))))
+        if matches:
+            financial_mutation = matches.pop(0)
+        else:
+            financial_mutation = statementpost['financial_mutations'][position]
+        if not staging.enabled:
+            # in the staging database the mutation is already indexed by MergeIntoStore
+            GetFinancialMutationsByMessage().setdefault(message, []).append(financial_mutation)
+            _unlinked_financial_mutations[financial_mutation['id']] = financial_mutation
+        financial_mutation_ids.append(financial_mutation['id'])
+
+    return financial_mutation_ids
+
+
+def AddFinancialStatementsInBatches(mutations):
+    """Post pending mutations, a list of (message, timestamp, amount_dec), as one statement per day with at most
+       statement_batch_size mutations each. Returns the ids of the created mutations, in the same order.
+    """
+    by_day = collections.OrderedDict()
+    for position, mutation in enumerate(mutations):
+        by_day.setdefault(mutation[1].strftime('%Y-%m-%d'), []).append((position, mutation))
+
+    financial_mutation_ids = [None] * len(mutations)
+    for day, day_mutations in by_day.items():
+        for start in range(0, len(day_mutations), statement_batch_size):
+            batch = day_mutations[start:start + statement_batch_size]
+            # the payments of a sale paid in parts share their message, name every sale once
+            messages = list(collections.OrderedDict.fromkeys(mutation[0] for _, mutation in batch))
+            if len(messages) == 1:
+                reference = messages[0]
+            else:
+                reference = "{0} t/m {1}".format(messages[0], messages[-1])
+            ids = AddFinancialStatementWithMutations(reference, [mutation for _, mutation in batch])
+            for (position, _), financial_mutation_id in zip(batch, ids):
+                financial_mutation_ids[position] = financial_mutation_id
+            logging.info("Created financial statement '{0}' ({1} mutations)".format(reference, len(batch)))
+    return financial_mutation_ids
 
 
 def LinkSalesInvoice(mutation_id, salesinvoice_id, amount_dec):
@@ -298,9 +563,12 @@ def LinkSalesInvoice(mutation_id, salesinvoice_id, amount_dec):
         "booking_id": salesinvoice_id,
         "price_base": "{0:f}".format(amount_dec)
     }
-    url = "https://moneybird.com/api/v2/{0}/financial_mutations/{1}/link_booking.json".format(administratie_id,
-                                                                                              mutation_id)
+    url = api_url + "/{0}/financial_mutations/{1}/link_booking.json".format(administratie_id, mutation_id)
     MakePatchRequest(url, link)
+    if staging.enabled:
+        staging.Execute('UPDATE financial_mutations SET unlinked = 0 WHERE id = ?', (str(mutation_id),))
+    elif _unlinked_financial_mutations is not None:
+        _unlinked_financial_mutations.pop(mutation_id, None)
 
 
 def MakeNegative(number):
@@ -316,13 +584,13 @@ def MakePositive(number):
 
 
 def AddSalesInvoice(reference, invoice_date, products):
+    ladgeraccountid = GetConfiguredIds()['grootboekrekening_omzet']
     details_attributes = []
     for product in products:
         description = product['description']
         if len(description) == 0:
             description = "Diversen"
         taxrateid = LookupTaxrateIdSales(product['tax_rate'])
-        ladgeraccountid = LookupLedgerAccountId(config['Moneybird']['grootboekrekening_omzet'])
         details_attribute = {
             "description": description,
             "price": "{0:f}".format(product['price']),
@@ -335,35 +603,214 @@ def AddSalesInvoice(reference, invoice_date, products):
     postObject = {"sales_invoice":
                       {"reference": reference,
                        "invoice_date": invoice_date.isoformat(),
-                       "contact_id": LookupContactId(config['Moneybird']['contact_passant']),
+                       "contact_id": GetConfiguredIds()['contact_passant'],
                        "details_attributes": details_attributes,
                        "prices_are_incl_tax": True
                        }
                   }
-    url = "https://moneybird.com/api/v2/{0}/sales_invoices".format(administratie_id)
+    url = api_url + "/{0}/sales_invoices".format(administratie_id)
     #print(json.dumps(postObject, sort_keys=True, indent=2))
     invoicepost = MakePostRequest(url, postObject)
     invoiceid = invoicepost['id']
+    if not staging.enabled:
+        GetSalesInvoicesByReference()[reference] = invoicepost
+    MergeIntoStore(store_sales_invoices, invoicepost)
     return invoiceid
 
 
 def SendInvoice(invoiceid):
-    url = "https://moneybird.com/api/v2/{0}/sales_invoices/{1}/send_invoice.json".format(administratie_id, invoiceid)
+    url = api_url + "/{0}/sales_invoices/{1}/send_invoice.json".format(administratie_id, invoiceid)
     postObject = {"sales_invoice_sending":
                       {"delivery_method": "Manual"
                        }
                   }
-    MakePatchRequest(url, postObject)
+    invoice = MakePatchRequest(url, postObject)
+    # sending changes the state and version of the invoice, keep the local store up to date
+    if isinstance(invoice, dict) and 'id' in invoice:
+        if not staging.enabled:
+            GetSalesInvoicesByReference()[invoice['reference']] = invoice
+        MergeIntoStore(store_sales_invoices, invoice)
+
+
+class _ThreadErrors(logging.Handler):
+    """Remembers the last error every thread logged, the api helpers log the reason before they exit"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.last = {}
+
+    def emit(self, record):
+        self.last[record.thread] = record.getMessage()
+
+
+def _AddAndSendSalesInvoice(reference, invoice_date, products, invoiceid, errors):
+    errors.last.pop(threading.get_ident(), None)
+    try:
+        if invoiceid is None:
+            invoiceid = AddSalesInvoice(reference, invoice_date, products)
+        if invoiceid is not None:
+            SendInvoice(invoiceid)
+    except SystemExit:
+        # for a batch we only want to give up on this invoice, with the reason instead of the exit code
+        return {'id': invoiceid, 'error': RuntimeError(errors.last.get(threading.get_ident(),
+                                                                       "the api helpers exited"))}
+    except Exception as err:
+        return {'id': invoiceid, 'error': err}
+    return {'id': invoiceid, 'error': None}
+
+
+def AddAndSendSalesInvoices(invoices):
+    """Create and send sales invoices, a list of (reference, invoice_date, products, invoiceid), with up to
+       write_workers invoices in flight at once. Every invoice is sent right after its own creation succeeded, an
+       invoiceid is a draft that was created before but not sent, it is only sent.
+       Returns a dict of reference -> {'id': ..., 'error': ...}, one failed invoice does not stop the others. The id
+       is set when the invoice was created, also when sending it failed and it is left as a draft.
+    """
+    results = {}
+    errors = _ThreadErrors()
+    logging.getLogger().addHandler(errors)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=write_workers) as executor:
+            futures = {}
+            for reference, invoice_date, products, invoiceid in invoices:
+                future = executor.submit(metrics.Bind(_AddAndSendSalesInvoice), reference, invoice_date, products,
+                                         invoiceid, errors)
+                futures[future] = reference
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        logging.getLogger().removeHandler(errors)
+    return results
+
+
+def _CountConnections(pool_class):
+    """Return a subclass of a urllib3 connection pool class whose connections count every socket they open"""
+    class CountingConnection(pool_class.ConnectionCls):
+        def connect(self):
+            global _HTTPConnectionsOpened
+            with _HTTPStatisticsLock:
+                _HTTPConnectionsOpened += 1
+            return super().connect()
+
+    return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+
+
+def GetSession():
+    """Return the keep-alive session that all Moneybird API calls share"""
+    global _Session, _HTTPAdapter
+    if _Session is None:
+        with _SessionLock:
+            if _Session is None:
+                # requests takes a while to import, a run that has nothing to do never gets here
+                import requests
+                import requests.adapters
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size)
+                adapter.poolmanager.pool_classes_by_scheme = {
+                    scheme: _CountConnections(pool_class)
+                    for scheme, pool_class in adapter.poolmanager.pool_classes_by_scheme.items()}
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({
+                    "authorization": "Bearer {0}".format(tokenMoneyBird),
+                    "accept-encoding": "gzip, deflate" if http_gzip else "identity"
+                })
+                _HTTPAdapter = adapter
+                _Session = session
+    return _Session
+
+
+def LogConnectionStatistics():
+    if _HTTPAdapter is None:
+        return
+    with _HTTPStatisticsLock:
+        requested, opened = _HTTPRequests, _HTTPConnectionsOpened
+    logging.info("Moneybird connections: {0} requests, {1} connections opened, {2} reused".format(
+        requested, opened, max(0, requested - opened)))
+
+
+def _AddThrottleWait(seconds):
+    global throttle_wait_seconds
+    with _RateLimitLock:
+        throttle_wait_seconds += seconds
+    metrics.Add('throttle_wait_seconds', seconds)
+
+
+def WaitForRateLimit():
+    """Take a token from the bucket, sleeping until one is available and until the api stopped throttling us"""
+    global _RateLimitTokens, _RateLimitUpdated
+    while True:
+        with _RateLimitLock:
+            now = time.monotonic()
+            if now < _RateLimitBlockedUntil:
+                wait = _RateLimitBlockedUntil - now
+            else:
+                _RateLimitTokens = min(float(rate_limit_requests), _RateLimitTokens +
+                                       (now - _RateLimitUpdated) * rate_limit_requests / rate_limit_period)
+                _RateLimitUpdated = now
+                if _RateLimitTokens >= 1:
+                    _RateLimitTokens -= 1
+                    return
+                wait = (1 - _RateLimitTokens) * rate_limit_period / rate_limit_requests
+        time.sleep(wait)
+        _AddThrottleWait(wait)
+
+
+def RetryAfterSeconds(r, attempt):
+    """Return how long to wait before retrying a throttled response, from the Retry-After header if present"""
+    retry_after = r.headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return min(60.0, 2.0 ** attempt)
+
+
+def BlockRateLimit(seconds):
+    """Stop all threads from calling the api for a while, and empty the bucket so they start again slowly"""
+    global _RateLimitTokens, _RateLimitUpdated, _RateLimitBlockedUntil
+    with _RateLimitLock:
+        until = time.monotonic() + seconds
+        if until > _RateLimitBlockedUntil:
+            _RateLimitBlockedUntil = until
+            _RateLimitTokens = 0.0
+            _RateLimitUpdated = until
+
+
+def MakeRequest(method, url, postObj=None):
+    """Do an api call through the shared session and rate limiter, retrying responses that were throttled"""
+    global throttle_retries, _HTTPRequests
+    attempt = 0
+    while True:
+        WaitForRateLimit()
+        r = GetSession().request(method, url, json=postObj, timeout=http_timeout)
+        with _HTTPStatisticsLock:
+            _HTTPRequests += 1
+        metrics.CountApiCall(method, url.replace("{0}/{1}".format(api_url, administratie_id), '', 1), r.status_code)
+        if r.status_code not in (429, 503) or attempt >= rate_limit_retries:
+            return r
+        wait = RetryAfterSeconds(r, attempt)
+        logging.warning("Moneybird answered {0} on {1}, retrying in {2:.1f}s".format(r.status_code, url, wait))
+        with _RateLimitLock:
+            throttle_retries += 1
+        metrics.Add('retries', 1)
+        # the wait happens in WaitForRateLimit, together with every other thread that wants to call the api
+        BlockRateLimit(wait)
+        attempt = attempt + 1
+
+
+def LogThrottleStatistics():
+    logging.info("Moneybird throttling: waited {0:.1f}s, {1} retries".format(throttle_wait_seconds,
+                                                                             throttle_retries))
 
 
 def MakeGetRequest(url):
     # print("DEBUG: get {0}".format(url))
-    global tokenMoneyBird
-
-    headers = {
-        "authorization": "Bearer {0}".format(tokenMoneyBird)
-    }
-    r = requests.get(url, headers=headers)
+    r = MakeRequest("GET", url)
     if r.status_code == 200:
         return r.json()
     else:
@@ -371,14 +818,39 @@ def MakeGetRequest(url):
         exit(1)
 
 
+def MakePagedGetRequest(url, per_page=100):
+    """Get all pages of a paginated endpoint. The first page is fetched on its own, most endpoints fit on it, only
+       when it comes back full the next pages are fetched with up to download_workers pages in flight at once.
+       The pages are collected in page order, and we stop at the first page that comes back short.
+    """
+    separator = '&' if '?' in url else '?'
+
+    def PageUrl(page):
+        return "{0}{1}page={2}&per_page={3}".format(url, separator, page, per_page)
+
+    items = MakeGetRequest(PageUrl(1))
+    if len(items) < per_page:
+        return items
+    with concurrent.futures.ThreadPoolExecutor(max_workers=download_workers) as executor:
+        pending = collections.deque()
+        page = 2
+        while True:
+            while len(pending) < download_workers:
+                pending.append(executor.submit(metrics.Bind(MakeGetRequest), PageUrl(page)))
+                page = page + 1
+            o = pending.popleft().result()
+            items.extend(o)
+            if len(o) < per_page:
+                break
+        # the pages after the last one are not needed anymore
+        for future in pending:
+            future.cancel()
+    return items
+
+
 def MakePostRequest(url, postObj):
     # print("DEBUG: post {0}".format(url))
-    global tokenMoneyBird
-
-    headers = {
-        "authorization": "Bearer {0}".format(tokenMoneyBird)
-    }
-    r = requests.post(url, json=postObj, headers=headers)
+    r = MakeRequest("POST", url, postObj)
     if r.status_code == 200:
         return r.json()
     if r.status_code == 201:
@@ -389,12 +861,7 @@ def MakePostRequest(url, postObj):
 
 
 def MakePatchRequest(url, postObj):
-    global tokenMoneyBird
-
-    headers = {
-        "authorization": "Bearer {0}".format(tokenMoneyBird)
-    }
-    r = requests.patch(url, json=postObj, headers=headers)
+    r = MakeRequest("PATCH", url, postObj)
     result = r.json()
     return result
 
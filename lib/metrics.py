@@ -0,0 +1,165 @@
+import collections
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from lib import profiles
+
+config = profiles.ReadConfig()
+
+# where the summary of the last run goes, an empty value switches that export off
+metrics_json = config.get('Global', 'metrics_json', fallback='log/unicenta2moneybird_metrics.json').strip()
+metrics_prometheus = config.get('Global', 'metrics_prometheus', fallback='log/unicenta2moneybird.prom').strip()
+if profiles.name is not None:
+    # every profile writes its own files, the Prometheus textfile collector picks them all up from one directory
+    metrics_json = profiles.Suffixed(metrics_json) if metrics_json else ''
+    metrics_prometheus = profiles.Suffixed(metrics_prometheus) if metrics_prometheus else ''
+
+# the stage that is counted when a thread did not set its own, the phase the run is in
+default_stage = 'startup'
+started = time.time()
+succeeded = False
+
+_lock = threading.Lock()
+_local = threading.local()
+stages = collections.OrderedDict()
+
+
+def _NewStage():
+    return {'wall_seconds': 0.0, 'rows_read': 0, 'bytes_staged': 0, 'api_calls': collections.Counter(),
+            'retries': 0, 'throttle_wait_seconds': 0.0}
+
+
+def GetStage():
+    return getattr(_local, 'stage', None) or default_stage
+
+
+def SetStage(name):
+    """Count everything this thread does from now on in a stage, None goes back to the default stage"""
+    _local.stage = name
+
+
+def Bind(func):
+    """Return func wrapped to run in the stage of the calling thread, for work handed to a thread pool"""
+    stage = GetStage()
+
+    def BoundCall(*args, **kwargs):
+        SetStage(stage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            SetStage(None)
+    return BoundCall
+
+
+def Add(counter, amount, stage=None):
+    with _lock:
+        values = stages.setdefault(stage or GetStage(), _NewStage())
+        values[counter] += amount
+
+
+def AddWallTime(stage, seconds):
+    """Record the wall time of a stage. Stages whose tasks overlap keep the longest one."""
+    with _lock:
+        values = stages.setdefault(stage, _NewStage())
+        values['wall_seconds'] = max(values['wall_seconds'], seconds)
+
+
+def AddStagedFile(filename):
+    Add('bytes_staged', os.path.getsize(filename))
+
+
+def CountApiCall(method, url, status):
+    # the endpoint without the query and with the record ids taken out, so the number of series stays small
+    endpoint = re.sub(r'/\d+(?=/|\.json|$)', '/{id}', url.split('?')[0])
+    with _lock:
+        values = stages.setdefault(GetStage(), _NewStage())
+        values['api_calls'][(method, endpoint, str(status))] += 1
+
+
+def Reset():
+    """Start counting a new run, in daemon mode every sync is a run of its own"""
+    global started, succeeded
+    with _lock:
+        stages.clear()
+        started = time.time()
+        succeeded = False
+
+
+def GetSummary():
+    with _lock:
+        summary = {
+            'profile': profiles.name,
+            'started': started,
+            'duration_seconds': round(time.time() - started, 3),
+            'success': succeeded,
+            'stages': collections.OrderedDict()
+        }
+        for stage, values in stages.items():
+            summary['stages'][stage] = {
+                'wall_seconds': round(values['wall_seconds'], 3),
+                'rows_read': values['rows_read'],
+                'bytes_staged': values['bytes_staged'],
+                'retries': values['retries'],
+                'throttle_wait_seconds': round(values['throttle_wait_seconds'], 3),
+                'api_calls': [{'method': method, 'endpoint': endpoint, 'status': status, 'count': count}
+                              for (method, endpoint, status), count in sorted(values['api_calls'].items())]
+            }
+    return summary
+
+
+def FormatPrometheus(summary, prefix='unicenta2moneybird'):
+    """Format a summary in the Prometheus text exposition format, for the node exporter textfile collector"""
+    lines = []
+
+    def Metric(name, help_text, samples):
+        lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help_text))
+        lines.append('# TYPE {0}_{1} gauge'.format(prefix, name))
+        for labels, value in samples:
+            if profiles.name is not None:
+                labels = (('profile', profiles.name),) + tuple(labels)
+            label_text = ','.join('{0}="{1}"'.format(key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, label in labels)
+            if label_text:
+                label_text = '{' + label_text + '}'
+            lines.append('{0}_{1}{2} {3}'.format(prefix, name, label_text, value))
+
+    Metric('last_run_timestamp_seconds', 'Start time of the last run', [((), summary['started'])])
+    Metric('last_run_duration_seconds', 'Wall time of the last run', [((), summary['duration_seconds'])])
+    Metric('last_run_success', 'Whether the last run finished without errors', [((), int(summary['success']))])
+    for counter, help_text in [('wall_seconds', 'Wall time of a stage'),
+                               ('rows_read', 'Rows read from uniCenta or Moneybird in a stage'),
+                               ('bytes_staged', 'Bytes written to the local stores in a stage'),
+                               ('retries', 'Throttled api calls that were retried in a stage'),
+                               ('throttle_wait_seconds', 'Time spent waiting on the rate limit in a stage')]:
+        Metric('stage_' + counter, help_text, [((('stage', stage),), values[counter])
+                                               for stage, values in summary['stages'].items()])
+    samples = []
+    for stage, values in summary['stages'].items():
+        for call in values['api_calls']:
+            samples.append(((('stage', stage), ('method', call['method']), ('endpoint', call['endpoint']),
+                             ('status', call['status'])), call['count']))
+    Metric('stage_api_calls', 'Moneybird api calls in a stage by endpoint and status', samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _WriteAtomic(filename, text):
+    # the collector may read at any moment, so never let it see a half written file
+    with open(filename + '.tmp', 'w') as outfile:
+        outfile.write(text)
+    os.replace(filename + '.tmp', filename)
+
+
+def Export():
+    """Write the summary of this run to the json and Prometheus files from the config"""
+    summary = GetSummary()
+    try:
+        if metrics_json:
+            _WriteAtomic(metrics_json, json.dumps(summary, indent=4))
+        if metrics_prometheus:
+            _WriteAtomic(metrics_prometheus, FormatPrometheus(summary))
+    except OSError as err:
+        logging.error("Could not write the run metrics: {0}".format(err))
@@ -0,0 +1,85 @@
+import concurrent.futures
+import configparser
+import logging
+import os
+import subprocess
+import sys
+import time
+
+config_file = 'etc/unicenta2moneybird.conf'
+
+# the store profile this process syncs, set by the parent process that fans out over the profiles
+name = os.environ.get('UNICENTA2MONEYBIRD_PROFILE') or None
+
+# every module reads the config at import, it is parsed once per profile and shared
+_Configs = {}
+
+
+def ReadConfig():
+    """Read the config. For a profile, the options of a [<section>:<profile>] section override the ones in
+       [<section>], so the settings all shops share only have to be in the config once.
+    """
+    if name in _Configs:
+        return _Configs[name]
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    if name is not None:
+        for section in config.sections():
+            override = '{0}:{1}'.format(section, name)
+            if ':' not in section and config.has_section(override):
+                for key, value in config.items(override, raw=True):
+                    config.set(section, key, value)
+    _Configs[name] = config
+    return config
+
+
+def GetProfileNames(config):
+    """Return the profiles listed in [Global] profiles, or an empty list when there is one store"""
+    profiles = config.get('Global', 'profiles', fallback='')
+    return [profile.strip() for profile in profiles.split(',') if profile.strip()]
+
+
+def VarPath(filename):
+    """Return the path of a state file, every profile keeps its state in its own directory in var/"""
+    if name is None:
+        return os.path.join('var', filename)
+    directory = os.path.join('var', name)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def Suffixed(filename):
+    """Return a log or metrics filename with the profile in it, so the profiles can share the log/ directory"""
+    if name is None:
+        return filename
+    base, extension = os.path.splitext(filename)
+    return '{0}_{1}{2}'.format(base, name, extension)
+
+
+def _RunProfile(profile, argv):
+    started = time.time()
+    environment = dict(os.environ)
+    environment['UNICENTA2MONEYBIRD_PROFILE'] = profile
+    returncode = subprocess.run([sys.executable] + argv, env=environment).returncode
+    return returncode, time.time() - started
+
+
+def RunProfiles(profiles, workers, argv):
+    """Sync every profile in a process of its own, with its own connections, with up to workers at once.
+       argv is the command line the profile processes are started with. Returns a dict of profile -> exit code.
+    """
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for profile in profiles:
+            futures[executor.submit(_RunProfile, profile, argv)] = profile
+        for future in concurrent.futures.as_completed(futures):
+            profile = futures[future]
+            returncode, duration = future.result()
+            results[profile] = returncode
+            if returncode == 0:
+                logging.info("Profile {0} finished in {1:.2f}s".format(profile, duration))
+            else:
+                logging.error("Profile {0} failed with exit code {1} after {2:.2f}s".format(profile, returncode,
+                                                                                             duration))
+    return results
@@ -0,0 +1,65 @@
+import collections
+import concurrent.futures
+import logging
+import time
+
+from lib import metrics
+
+# the phase that is running now, as (name, start time), and the durations of the finished phases
+_CurrentPhase = None
+phase_durations = collections.OrderedDict()
+
+
+def _TimedCall(func, args, stage):
+    metrics.SetStage(stage)
+    started = time.time()
+    try:
+        func(*args)
+    finally:
+        metrics.SetStage(None)
+    duration = time.time() - started
+    metrics.AddWallTime(stage, duration)
+    return duration
+
+
+def RunTasks(tasks, workers):
+    """Run independent tasks, a list of (name, function, args, stage), on a thread pool and wait until all are done.
+       Logs the duration of every task and the critical path, the task that kept the others waiting. The metrics
+       of a task are counted in its stage.
+    """
+    started = time.time()
+    durations = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name, func, args, stage in tasks:
+            futures[executor.submit(_TimedCall, func, args, stage)] = name
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            # re-raises any error (or exit) from the task
+            durations[name] = future.result()
+            logging.info("Task {0} finished in {1:.2f}s".format(name, durations[name]))
+
+    if len(durations) > 0:
+        critical = max(durations, key=durations.get)
+        logging.info("Ran {0} tasks in {1:.2f}s, critical path: {2} ({3:.2f}s)".format(
+            len(durations), time.time() - started, critical, durations[critical]))
+    return durations
+
+
+def StartPhase(name):
+    """Start timing a phase of the run, this ends the phase that was running"""
+    global _CurrentPhase
+    EndPhase()
+    _CurrentPhase = (name, time.time())
+    metrics.default_stage = name
+
+
+def EndPhase():
+    global _CurrentPhase
+    if _CurrentPhase is None:
+        return
+    name, started = _CurrentPhase
+    phase_durations[name] = time.time() - started
+    metrics.AddWallTime(name, phase_durations[name])
+    logging.info("Phase {0} finished in {1:.2f}s".format(name, phase_durations[name]))
+    _CurrentPhase = None
@@ -0,0 +1,165 @@
+import datetime
+import itertools
+import json
+import logging
+import sqlite3
+import threading
+
+from lib import metrics, profiles
+
+config = profiles.ReadConfig()
+
+# 'json' keeps the stores as files in var/, 'sqlite' stages everything in one indexed database
+enabled = config.get('Global', 'staging', fallback='json').strip() == 'sqlite'
+staging_database = config.get('Global', 'staging_database', fallback=None)
+if staging_database is None:
+    staging_database = profiles.VarPath('staging.sqlite')
+else:
+    # the profiles must never share a staging database, their tables have the same keys
+    staging_database = profiles.Suffixed(staging_database)
+
+# every table keeps the full record as json in 'data', next to the columns we join and search on
+_schema = [
+    'CREATE TABLE IF NOT EXISTS tickets (id TEXT PRIMARY KEY, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS ticketlines (ticket TEXT, line INTEGER, data TEXT, PRIMARY KEY (ticket, line))',
+    'CREATE TABLE IF NOT EXISTS receipts (id TEXT PRIMARY KEY, datenew TEXT, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS receipts_datenew ON receipts (datenew)',
+    'CREATE TABLE IF NOT EXISTS payments (id TEXT PRIMARY KEY, receipt TEXT, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS payments_receipt ON payments (receipt)',
+    'CREATE TABLE IF NOT EXISTS taxes (id TEXT PRIMARY KEY, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS sales_invoices (id TEXT PRIMARY KEY, reference TEXT, version INTEGER, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS sales_invoices_reference ON sales_invoices (reference)',
+    'CREATE TABLE IF NOT EXISTS financial_mutations (id TEXT PRIMARY KEY, message TEXT, version INTEGER, '
+    'unlinked INTEGER, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS financial_mutations_message ON financial_mutations (message)',
+    'CREATE INDEX IF NOT EXISTS financial_mutations_unlinked ON financial_mutations (unlinked)',
+]
+
+_columns = {
+    'tickets': ['id'],
+    'ticketlines': ['ticket', 'line'],
+    'receipts': ['id', 'datenew'],
+    'payments': ['id', 'receipt'],
+    'taxes': ['id'],
+    'sales_invoices': ['id', 'reference', 'version'],
+    'financial_mutations': ['id', 'message', 'version', 'unlinked'],
+}
+
+# sqlite connections can not be shared between threads, so every thread gets its own
+_local = threading.local()
+
+# sqlite allows one writer at a time, the threads take turns per batch instead of waiting on the busy timeout
+_WriteLock = threading.Lock()
+
+
+def GetConnection():
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(staging_database, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in _schema:
+            connection.execute(statement)
+        connection.commit()
+        _local.connection = connection
+    return connection
+
+
+def _ColumnValue(record, column):
+    if column == 'unlinked':
+        return 1 if len(record['payments']) == 0 else 0
+    value = record[column]
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (int, float)) and column != 'line' and column != 'version':
+        return str(value)
+    return value
+
+
+def UpsertRecords(table, records, default=None, batch_size=1000):
+    """Insert or replace records in a staging table, reading them in batches so any iterable can be passed.
+       Every batch is committed on its own, so a long streamed extract does not hold the write lock while it
+       reads the next rows. Returns the number of records.
+    """
+    columns = _columns[table] + ['data']
+    statement = 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})'.format(table, ', '.join(columns),
+                                                                        ', '.join('?' * len(columns)))
+    connection = GetConnection()
+    count = 0
+    size = 0
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if len(batch) == 0:
+            break
+        rows = []
+        for record in batch:
+            row = [_ColumnValue(record, column) for column in _columns[table]]
+            row.append(json.dumps(record, sort_keys=True, default=default))
+            size += len(row[-1])
+            rows.append(row)
+        with _WriteLock:
+            connection.executemany(statement, rows)
+            connection.commit()
+        count += len(rows)
+    metrics.Add('bytes_staged', size)
+    return count
+
+
+def GetRecords(table, where='', params=(), order=''):
+    """Yield the records of a staging table, optionally filtered with a WHERE clause on the indexed columns"""
+    cursor = GetConnection().execute('SELECT data FROM {0} {1} {2}'.format(table, where, order), params)
+    for (data,) in cursor:
+        yield json.loads(data)
+
+
+def GetRecord(table, column, value):
+    """Return the first record with the given value in a column, or None"""
+    for record in GetRecords(table, 'WHERE {0} = ?'.format(column), (value,), 'LIMIT 1'):
+        return record
+    return None
+
+
+def GetVersions(table):
+    """Return a dict of id -> version of a staging table"""
+    versions = {}
+    for record_id, version in GetConnection().execute('SELECT id, version FROM {0}'.format(table)):
+        versions[record_id] = version
+    return versions
+
+
+def Execute(statement, params=()):
+    connection = GetConnection()
+    with _WriteLock:
+        connection.execute(statement, params)
+        connection.commit()
+
+
+class KeyedTable:
+    """Read-only dict-like view on a staging table, looked up through the index on one column.
+       With many=True a lookup returns the list of all records with that key.
+    """
+
+    def __init__(self, table, column, many=False):
+        self.table = table
+        self.column = column
+        self.many = many
+
+    def get(self, key, default=None):
+        if self.many:
+            records = list(GetRecords(self.table, 'WHERE {0} = ?'.format(self.column), (key,), 'ORDER BY rowid'))
+            return records if len(records) > 0 else default
+        record = GetRecord(self.table, self.column, key)
+        return record if record is not None else default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+def LogStatistics():
+    if not enabled:
+        return
+    counts = []
+    for table in _columns:
+        (count,) = GetConnection().execute('SELECT COUNT(*) FROM {0}'.format(table)).fetchone()
+        counts.append('{0} {1}'.format(count, table))
+    logging.info("Staging database {0}: {1}".format(staging_database, ', '.join(counts)))
@@ -1,45 +1,138 @@
-import configparser
 import logging
 import json
 import datetime
-import mysql.connector
+import functools
+import threading
 import xml.etree.ElementTree
 
+from lib import cache, metrics, profiles, staging
+
 # from lib import log
 
 # default verbosity, will be overwritten by main class
 flagVerbose = False
 
-config = configparser.ConfigParser()
-config.read('etc/unicenta2moneybird.conf')
+config = profiles.ReadConfig()
 Unicenta_MySQL_host = config['Unicenta']['Unicenta_MySQL_host']
 Unicenta_MySQL_user = config['Unicenta']['Unicenta_MySQL_user']
 Unicenta_MySQL_pass = config['Unicenta']['Unicenta_MySQL_pass']
 Unicenta_MySQL_db = config['Unicenta']['Unicenta_MySQL_db']
+Unicenta_MySQL_pool_size = int(config.get('Unicenta', 'Unicenta_MySQL_pool_size', fallback='5'))
+attribute_cache_size = int(config.get('Unicenta', 'attribute_cache_size', fallback='4096'))
 
-ticketsfile = "var/unicenta_tickets.json"
-ticketlinesfile = "var/unicenta_ticketlines.json"
-receiptsfile = "var/unicenta_receipts.json"
-paymentsfile = "var/unicenta_payments.json"
-taxesfile = "var/unicenta_taxes.json"
+ticketsfile = profiles.VarPath('unicenta_tickets.ndjson')
+ticketlinesfile = profiles.VarPath('unicenta_ticketlines.ndjson')
+receiptsfile = profiles.VarPath('unicenta_receipts.ndjson')
+paymentsfile = profiles.VarPath('unicenta_payments.ndjson')
+taxesfile = profiles.VarPath('unicenta_taxes.ndjson')
 
-customsalesfile = "var/custom_sales.json"
+customsalesfile = profiles.VarPath('custom_sales.json')
+syncstatefile = profiles.VarPath('unicenta_sync_state.json')
 
 _DBConnection = None
+_DBPool = None
+# the download threads share the pool, it is created once and a thread waits for a free connection instead of
+# failing when more extracts run than the pool has connections
+_DBPoolLock = threading.Lock()
+_DBPoolSlots = threading.BoundedSemaphore(Unicenta_MySQL_pool_size)
+_TaxRatesByCategory = None
+_PaymentMethodFilter = None
 
 
 def GetDBConnection():
+    """Return the shared connection. It autocommits, so a connection that is kept open (in daemon mode) does not
+       keep reading the snapshot of its first query, and it reconnects when the server closed it while idle.
+    """
     global _DBConnection
     if _DBConnection is None:
+        # the connector is only imported when we really talk to the database, it is slow to import
+        import mysql.connector
         _DBConnection = mysql.connector.connect(
             host=Unicenta_MySQL_host,
             user=Unicenta_MySQL_user,
             passwd=Unicenta_MySQL_pass,
-            database=Unicenta_MySQL_db
+            database=Unicenta_MySQL_db,
+            autocommit=True
         )
+    else:
+        _DBConnection.ping(reconnect=True, attempts=3, delay=1)
     return _DBConnection
 
 
+def GetPooledDBConnection():
+    """Return a connection from the pool, so extracts can run in parallel. Waits while all connections are in use,
+       give it back with ReleasePooledDBConnection.
+    """
+    global _DBPool
+    if _DBPool is None:
+        with _DBPoolLock:
+            if _DBPool is None:
+                import mysql.connector.pooling
+                _DBPool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name="unicenta",
+                    pool_size=Unicenta_MySQL_pool_size,
+                    host=Unicenta_MySQL_host,
+                    user=Unicenta_MySQL_user,
+                    passwd=Unicenta_MySQL_pass,
+                    database=Unicenta_MySQL_db
+                )
+    _DBPoolSlots.acquire()
+    try:
+        return _DBPool.get_connection()
+    except Exception:
+        _DBPoolSlots.release()
+        raise
+
+
+def ReleasePooledDBConnection(connection):
+    try:
+        connection.close()
+    finally:
+        _DBPoolSlots.release()
+
+
+def ReceiptWindow(startDate, endDate):
+    """Return the WHERE clause and parameters that limit a query to receipts inside the date window"""
+    if startDate is None or endDate is None:
+        return '', ()
+    return ' WHERE receipts.datenew > %s AND receipts.datenew < %s', (startDate, endDate)
+
+
+def StreamQueryToStore(mysql_query, params, filename, table):
+    """Run a query on an unbuffered cursor and write every row as one json line, or upsert the rows into the
+       staging database when that is enabled. Returns the number of rows.
+    """
+    connection = GetPooledDBConnection()
+    try:
+        mycursor = connection.cursor(dictionary=True, buffered=False)
+        mycursor.execute(mysql_query, params)
+        if staging.enabled:
+            count = staging.UpsertRecords(table, mycursor, default=json_serial)
+        else:
+            count = 0
+            with open(filename, 'w') as outfile:
+                for row in mycursor:
+                    outfile.write(json.dumps(row, sort_keys=True, default=json_serial))
+                    outfile.write('\n')
+                    count += 1
+        mycursor.close()
+    finally:
+        ReleasePooledDBConnection(connection)
+    cache.Invalidate(filename)
+    metrics.Add('rows_read', count)
+    if not staging.enabled:
+        metrics.AddStagedFile(filename)
+    return count
+
+
+def ReadRowsFromFile(filename):
+    """Yield the rows of a ndjson store one by one, without loading the whole file"""
+    with open(filename) as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                yield json.loads(line)
+
+
 def json_serial(obj):
     """JSON serializer for objects not serializable by default json code"""
     if isinstance(obj, (datetime.datetime, datetime.date)):
@@ -47,195 +140,334 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
-def DownloadTickets():
-    mysql_query = 'SELECT * FROM tickets'
-    mycursor = GetDBConnection().cursor(dictionary=True)
-    mycursor.execute(mysql_query)
-    result = mycursor.fetchall()
-    with open(ticketsfile, 'w') as outfile:
-        json.dump(result, outfile, indent=4, sort_keys=True, default=json_serial)
-    logging.info('Downloaded uniCenta tickets ({0} items)'.format(len(result)))
+def DownloadTickets(startDate=None, endDate=None):
+    # only the rows that belong to receipts inside the window, or everything when no window is given
+    where, params = ReceiptWindow(startDate, endDate)
+    if where:
+        mysql_query = 'SELECT tickets.* FROM tickets JOIN receipts ON receipts.id = tickets.id' + where
+    else:
+        mysql_query = 'SELECT * FROM tickets'
+    count = StreamQueryToStore(mysql_query, params, ticketsfile, 'tickets')
+    logging.info('Downloaded uniCenta tickets ({0} items)'.format(count))
 
 
 def GetTickets():
-    with open(ticketsfile) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('tickets'))
+    return cache.Load(ticketsfile)
 
 
-def DownloadTicketLines():
-    mysql_query = 'SELECT * FROM ticketlines'
-    mycursor = GetDBConnection().cursor(dictionary=True)
-    mycursor.execute(mysql_query)
-    result = mycursor.fetchall()
-    with open(ticketlinesfile, 'w') as outfile:
-        json.dump(result, outfile, indent=4, sort_keys=True, default=json_serial)
-    logging.info('Downloaded uniCenta ticketlines ({0} items)'.format(len(result)))
+def IterTickets():
+    if staging.enabled:
+        return staging.GetRecords('tickets')
+    return ReadRowsFromFile(ticketsfile)
+
+
+def DownloadTicketLines(startDate=None, endDate=None):
+    # only the rows that belong to receipts inside the window, or everything when no window is given
+    where, params = ReceiptWindow(startDate, endDate)
+    if where:
+        mysql_query = 'SELECT ticketlines.* FROM ticketlines JOIN receipts ON receipts.id = ticketlines.ticket' + where
+    else:
+        mysql_query = 'SELECT * FROM ticketlines'
+    count = StreamQueryToStore(mysql_query, params, ticketlinesfile, 'ticketlines')
+    logging.info('Downloaded uniCenta ticketlines ({0} items)'.format(count))
 
 
 def GetTicketLines():
-    with open(ticketlinesfile) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('ticketlines'))
+    return cache.Load(ticketlinesfile)
 
 
-def DownloadReceipts():
-    mysql_query = 'SELECT * FROM receipts ORDER BY datenew'
-    mycursor = GetDBConnection().cursor(dictionary=True)
-    mycursor.execute(mysql_query)
-    result = mycursor.fetchall()
-    with open(receiptsfile, 'w') as outfile:
-        json.dump(result, outfile, indent=4, sort_keys=True, default=json_serial)
-    logging.info('Downloaded uniCenta receipts ({0} items)'.format(len(result)))
+def IterTicketLines():
+    if staging.enabled:
+        return staging.GetRecords('ticketlines')
+    return ReadRowsFromFile(ticketlinesfile)
+
+
+def DownloadReceipts(startDate=None, endDate=None):
+    where, params = ReceiptWindow(startDate, endDate)
+    mysql_query = 'SELECT * FROM receipts' + where + ' ORDER BY datenew'
+    count = StreamQueryToStore(mysql_query, params, receiptsfile, 'receipts')
+    logging.info('Downloaded uniCenta receipts ({0} items)'.format(count))
 
 
 def GetReceipts():
-    with open(receiptsfile) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('receipts'))
+    return cache.Load(receiptsfile)
 
 
-def DownloadPayments():
-    mysql_query = 'SELECT * FROM payments'
-    mycursor = GetDBConnection().cursor(dictionary=True)
-    mycursor.execute(mysql_query)
-    result = mycursor.fetchall()
-    with open(paymentsfile, 'w') as outfile:
-        json.dump(result, outfile, indent=4, sort_keys=True, default=json_serial)
-    logging.info('Downloaded uniCenta payments ({0} items)'.format(len(result)))
+def IterReceipts():
+    if staging.enabled:
+        return staging.GetRecords('receipts')
+    return ReadRowsFromFile(receiptsfile)
+
+
+def DownloadPayments(startDate=None, endDate=None):
+    # only the rows that belong to receipts inside the window, or everything when no window is given
+    where, params = ReceiptWindow(startDate, endDate)
+    if where:
+        mysql_query = 'SELECT payments.* FROM payments JOIN receipts ON receipts.id = payments.receipt' + where
+    else:
+        mysql_query = 'SELECT * FROM payments'
+    count = StreamQueryToStore(mysql_query, params, paymentsfile, 'payments')
+    logging.info('Downloaded uniCenta payments ({0} items)'.format(count))
 
 
 def GetPayments():
-    with open(paymentsfile) as json_file:
-        data = json.load(json_file)
-    return data
+    if staging.enabled:
+        return list(staging.GetRecords('payments'))
+    return cache.Load(paymentsfile)
+
+
+def IterPayments():
+    if staging.enabled:
+        return staging.GetRecords('payments')
+    return ReadRowsFromFile(paymentsfile)
 
 
 def DownloadTaxes():
     mysql_query = 'SELECT * FROM taxes'
+    count = StreamQueryToStore(mysql_query, (), taxesfile, 'taxes')
+    global _TaxRatesByCategory
+    _TaxRatesByCategory = None
+    logging.info('Downloaded uniCenta taxes ({0} items)'.format(count))
+
+
+def GetTaxes():
+    if staging.enabled:
+        return list(staging.GetRecords('taxes'))
+    return cache.Load(taxesfile)
+
+
+def GetLatestReceipt():
+    """Return the high-water mark of the uniCenta database: the datenew and ticketid of the newest receipt"""
+    mysql_query = 'SELECT receipts.datenew, tickets.ticketid FROM receipts JOIN tickets ON tickets.id = receipts.id ' \
+                  'ORDER BY receipts.datenew DESC, tickets.ticketid DESC LIMIT 1'
     mycursor = GetDBConnection().cursor(dictionary=True)
     mycursor.execute(mysql_query)
-    result = mycursor.fetchall()
-    with open(taxesfile, 'w') as outfile:
-        json.dump(result, outfile, indent=4, sort_keys=True, default=json_serial)
-    logging.info('Downloaded uniCenta taxes ({0} items)'.format(len(result)))
+    row = mycursor.fetchone()
+    mycursor.close()
+    if row is None:
+        return None
+    return {'datenew': row['datenew'].isoformat(), 'ticketid': row['ticketid']}
 
 
-def GetTaxes():
-    with open(taxesfile) as json_file:
-        data = json.load(json_file)
-    return data
+def GetSyncState():
+    """Return the high-water mark saved by the previous run, or None if there is none"""
+    try:
+        with open(syncstatefile) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+
+
+def SaveSyncState(mark):
+    with open(syncstatefile, 'w') as outfile:
+        json.dump(mark, outfile, indent=4, sort_keys=True)
+    logging.info('Saved uniCenta sync state (receipt {0} at {1})'.format(mark['ticketid'], mark['datenew']))
+
+
+def GetTaxRatesByCategory():
+    """Return a dict of tax category -> rate"""
+    global _TaxRatesByCategory
+    if _TaxRatesByCategory is None:
+        # filled aside, the threads that parse ticketlines only ever see the complete dict
+        rates = {}
+        for tax in GetTaxes():
+            rates.setdefault(tax['category'], tax['rate'])
+        _TaxRatesByCategory = rates
+    return _TaxRatesByCategory
 
 
 def LookupTaxrate(categoryid):
-    for tax in GetTaxes():
-        if tax['category'] == categoryid:
-            return tax['rate']
+    rate = GetTaxRatesByCategory().get(categoryid)
+    if rate is not None:
+        return rate
     logging.error("Cannot find tax category {0}".format(categoryid))
     exit(1)
 
 
-def validateCustomSale(sale):
-    # validate the sale to see if it is valid (fully paid, etc)
-
-    # Payment method filter
-    filter_exists = config.has_option('Unicenta', 'Payment_method_filter')
-    if filter_exists:
+@functools.lru_cache(maxsize=attribute_cache_size)
+def ParseTicketLineAttributes(xmlattribute):
+    """Return (taxcategoryid, product name) from the attributes of a ticketline, None for a missing entry.
+       The same product attributes come back on every line the product is sold, so the result is cached.
+    """
+    taxcategoryid = None
+    name = None
+    tree = xml.etree.ElementTree.fromstring(xmlattribute)
+    for elem in tree:
+        if elem.tag == "entry":
+            if elem.attrib['key'] == "product.taxcategoryid":
+                taxcategoryid = elem.text
+            if elem.attrib['key'] == "product.name":
+                name = elem.text
+    return taxcategoryid, name
+
+
+def GetPaymentMethodFilter():
+    """Return the set of allowed payment methods from the config, or None when there is no filter"""
+    global _PaymentMethodFilter
+    if _PaymentMethodFilter is None and config.has_option('Unicenta', 'Payment_method_filter'):
         payment_method_filter = str(config['Unicenta']['Payment_method_filter'])
-        payment_method_filter_items = []
-        for item in payment_method_filter.split(','):
-            payment_method_filter_items.append(item.strip())
-
-        for payment in sale['payments']:
-            if payment['method'] not in payment_method_filter_items:
-                logging.warning("Sale '{0}' has a payment method '{1}'. This is not allowed according to your "
-                                "configured filter '{2}'. Ignoring sale.".format(sale['reference'], payment['method'],
-                                                                                 payment_method_filter_items))
-                return False
-
-    # get the total of all the products
-    total_amount_products = 0
-    for product in sale['products']:
-        total_amount_products += product['priceexcl'] * (1 + product['taxrate']) * product['quantity']
-    # print("total_amount_products: {0}".format(total_amount_products))
-
-    # get the total of all the payments
-    total_amount_payments = 0
-    for payment in sale['payments']:
-        total_amount_payments += payment['amount']
-    # print("total_amount_payments: {0}".format(total_amount_payments))
-
-    match = numericEqual(total_amount_products, total_amount_payments)
-
-    if not match:
-        logging.warning("Sale '{0}' can not be validated: the amount of products is {1}, but the payment is {2}. "
-                        "Ignoring sale.".format(sale['reference'], total_amount_products, total_amount_payments))
-        return False
-    # print("match: {0}".format())
-    return True
-
-
-def numericEqual(x, y, epsilon=1 * 10 ** (-8)):
-    """Return True if two values are close in numeric value
-        By default close is withing 1*10^-8 of each other
-        i.e. 0.00000001
+        _PaymentMethodFilter = set(item.strip() for item in payment_method_filter.split(','))
+    return _PaymentMethodFilter
+
+
+def ValidateSales(sales):
+    """Validate all candidate sales at once: every payment method must pass the configured filter, and the
+       products must add up to the payments. Amounts are compared in whole cents, each product line is
+       rounded to cents before it is added up.
+       Returns (valid, rejected), where rejected is a list of (sale, reason).
     """
-    return abs(x - y) <= epsilon
+    # numpy is only needed here, importing it would slow down the start of every run
+    import numpy
+
+    # flatten all product lines and payments into arrays, with the position of their sale
+    product_sale = []
+    product_amount = []
+    payment_sale = []
+    payment_amount = []
+    for position, sale in enumerate(sales):
+        for product in sale.get('products', []):
+            product_sale.append(position)
+            product_amount.append(product['priceexcl'] * (1 + product['taxrate']) * product['quantity'])
+        for payment in sale.get('payments', []):
+            payment_sale.append(position)
+            payment_amount.append(payment['amount'])
+
+    product_cents = numpy.rint(numpy.array(product_amount, dtype=numpy.float64) * 100).astype(numpy.int64)
+    payment_cents = numpy.rint(numpy.array(payment_amount, dtype=numpy.float64) * 100).astype(numpy.int64)
+    total_products = numpy.zeros(len(sales), dtype=numpy.int64)
+    total_payments = numpy.zeros(len(sales), dtype=numpy.int64)
+    numpy.add.at(total_products, numpy.array(product_sale, dtype=numpy.int64), product_cents)
+    numpy.add.at(total_payments, numpy.array(payment_sale, dtype=numpy.int64), payment_cents)
+    totals_match = total_products == total_payments
+
+    payment_method_filter = GetPaymentMethodFilter()
+    valid = []
+    rejected = []
+    for position, sale in enumerate(sales):
+        if 'reference' not in sale:
+            rejected.append((sale, "there is no ticket for the receipt of {0}".format(sale['date'])))
+            continue
+        if payment_method_filter is not None:
+            methods = [payment['method'] for payment in sale['payments']
+                       if payment['method'] not in payment_method_filter]
+            if len(methods) > 0:
+                rejected.append((sale, "it has a payment method '{0}', which is not allowed according to your "
+                                       "configured filter {1}".format(methods[0], sorted(payment_method_filter))))
+                continue
+        if not totals_match[position]:
+            rejected.append((sale, "the amount of products is {0:.2f}, but the payment is {1:.2f}".format(
+                total_products[position] / 100, total_payments[position] / 100)))
+            continue
+        valid.append(sale)
+    return valid, rejected
+
+
+def validateCustomSale(sale):
+    # validate the sale to see if it is valid (fully paid, etc)
+    valid, rejected = ValidateSales([sale])
+    for rejected_sale, reason in rejected:
+        logging.warning("Sale '{0}' can not be validated: {1}. Ignoring sale.".format(
+            rejected_sale.get('reference'), reason))
+    return len(valid) == 1
 
 
 def TransformSales(startDate, endDate):
+    if staging.enabled:
+        # the staging database has indexes on the join columns, so every receipt only reads its own rows
+        receipts = staging.GetRecords('receipts', 'WHERE datenew > ? AND datenew < ?',
+                                      (startDate.isoformat(), endDate.isoformat()), 'ORDER BY datenew')
+
+        def LookupTicket(ticketid):
+            return staging.GetRecord('tickets', 'id', ticketid)
+
+        def LookupTicketLines(ticketid):
+            return staging.GetRecords('ticketlines', 'WHERE ticket = ?', (ticketid,), 'ORDER BY line')
+
+        def LookupPayments(receiptid):
+            return staging.GetRecords('payments', 'WHERE receipt = ?', (receiptid,), 'ORDER BY id')
+    else:
+        # index the uc tables once, so every receipt is joined with dictionary lookups instead of full scans.
+        # The stores are streamed from disk, so only the indexes (the rows of the downloaded window) stay in memory.
+        tickets_by_id = {}
+        for ticket in IterTickets():
+            tickets_by_id[ticket['id']] = ticket
+
+        ticketlines_by_ticket = {}
+        for ticketline in IterTicketLines():
+            ticketlines_by_ticket.setdefault(ticketline['ticket'], []).append(ticketline)
+
+        payments_by_receipt = {}
+        for ucpayment in IterPayments():
+            payments_by_receipt.setdefault(ucpayment['receipt'], []).append(ucpayment)
+
+        receipts = IterReceipts()
+
+        def LookupTicket(ticketid):
+            return tickets_by_id.get(ticketid)
+
+        def LookupTicketLines(ticketid):
+            return ticketlines_by_ticket.get(ticketid, [])
+
+        def LookupPayments(receiptid):
+            return payments_by_receipt.get(receiptid, [])
+
     sales = []
-    for receipt in GetReceipts():
+    receiptcount = 0
+    for receipt in receipts:
+        receiptcount += 1
         # this is a custom object to massage uc objects into mb format
         sale = {}
         sale['date'] = datetime.datetime.strptime(receipt['datenew'], "%Y-%m-%dT%H:%M:%S")
         if startDate < sale['date'] < endDate:
-            for ticket in GetTickets():
-                if ticket['id'] == receipt['id']:
-                    sale['reference'] = "POS verkoop {0}".format(ticket['ticketid'])
-                    products = []
-                    for ticketline in GetTicketLines():
-                        if ticketline['ticket'] == ticket['id']:
-                            productline = {}
-                            productline['number'] = ticketline['line']
-                            productline['priceexcl'] = ticketline['price']
-                            productline['quantity'] = ticketline['units']
-
-                            xmlattribute = ticketline['attributes']
-                            tree = xml.etree.ElementTree.fromstring(xmlattribute)
-                            for elem in tree:
-                                if elem.tag == "entry":
-                                    #print("{0}: {1}".format(elem.attrib['key'], elem.text))
-                                    if elem.attrib['key'] == "product.taxcategoryid":
-                                        ticketLineTaxCategoryId = elem.text
-                                        productline['taxrate'] = LookupTaxrate(ticketLineTaxCategoryId)
-                                    if elem.attrib['key'] == "product.name":
-                                        productline['description'] = elem.text
-                            products.append(productline)
-                    sale['products'] = products
-
-                    payments = []
-                    for ucpayment in GetPayments():
-                        payment = {}
-                        if ucpayment['receipt'] == receipt['id']:
-                            #print(ucpayment)
-                            payment['method'] = ucpayment['payment']
-                            payment['amount'] = ucpayment['total']
-                            payment['transactionid'] = ucpayment['transid']
-                            payments.append(payment)
-                    sale['payments'] = payments
-
-            if validateCustomSale(sale):
-                sales.append(sale)
+            ticket = LookupTicket(receipt['id'])
+            if ticket is not None:
+                sale['reference'] = "POS verkoop {0}".format(ticket['ticketid'])
+                products = []
+                for ticketline in LookupTicketLines(ticket['id']):
+                    productline = {}
+                    productline['number'] = ticketline['line']
+                    productline['priceexcl'] = ticketline['price']
+                    productline['quantity'] = ticketline['units']
+
+                    ticketLineTaxCategoryId, ticketLineName = ParseTicketLineAttributes(ticketline['attributes'])
+                    if ticketLineTaxCategoryId is not None:
+                        productline['taxrate'] = LookupTaxrate(ticketLineTaxCategoryId)
+                    if ticketLineName is not None:
+                        productline['description'] = ticketLineName
+                    products.append(productline)
+                sale['products'] = products
+
+                payments = []
+                for ucpayment in LookupPayments(receipt['id']):
+                    payment = {}
+                    payment['method'] = ucpayment['payment']
+                    payment['amount'] = ucpayment['total']
+                    payment['transactionid'] = ucpayment['transid']
+                    payments.append(payment)
+                sale['payments'] = payments
+
+            sales.append(sale)
         else:
             logging.info("Skipping sale as the date {0} is not in the selection.".format(sale['date']))
 
+    # validate all sales in one go
+    sales, rejected = ValidateSales(sales)
+    for sale, reason in rejected:
+        logging.warning("Sale '{0}' can not be validated: {1}. Ignoring sale.".format(sale.get('reference'), reason))
+
     with open(customsalesfile, 'w') as outfile:
         json.dump(sales, outfile, indent=4, sort_keys=True, default=json_serial)
+    cache.Invalidate(customsalesfile)
+    metrics.Add('rows_read', receiptcount)
+    metrics.AddStagedFile(customsalesfile)
     logging.info('Transformed uniCenta sales ({0} items)'.format(len(sales)))
 
 
 def GetTransformedSales():
-    with open(customsalesfile) as json_file:
-        data = json.load(json_file)
-    return data
+    return cache.Load(customsalesfile)
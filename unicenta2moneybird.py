@@ -1,10 +1,12 @@
-import configparser
 import decimal
+import os
 import sys
 import datetime
 import argparse
+import atexit
+import time
 
-from lib import uc, mb, log
+from lib import log, profiles
 
 parser = argparse.ArgumentParser(description='Sync iZettle to your Moneybird account.')
 parser.add_argument('-n', '--noop', dest='noop', action='store_true', help="Only read, do not really change anything")
@@ -17,13 +19,23 @@ parser.add_argument('--enddate', dest='enddatestring', type=str, help="The date
                                                                       "example format 31122019 for dec "
                                                                       "31st, 2019. If not specified, it "
                                                                       "will be tomorrow.")
+parser.add_argument('--full', dest='full', action='store_true', help="Ignore the saved sync state and process "
+                                                                     "the whole date window again")
+parser.add_argument('--daemon', dest='daemon', action='store_true', help="Keep running and sync new receipts "
+                                                                         "as they come in, polling every "
+                                                                         "daemon_poll_seconds")
+parser.add_argument('--backfill', dest='backfill', action='store_true', help="Process the window from --startdate "
+                                                                             "in partitions of backfill_partition, "
+                                                                             "resuming after the partitions an "
+                                                                             "interrupted backfill completed")
+parser.add_argument('--profile', dest='profile', type=str, help="Only sync this store profile from [Global] "
+                                                                "profiles")
 args = parser.parse_args()
 flagNoop = args.noop
 flagVerbose = args.verbose
 
-uc.flagVerbose = flagVerbose
-mb.flagVerbose = flagVerbose
-mb.flagNoop = flagNoop
+if args.profile is not None:
+    profiles.name = args.profile
 
 ######################################
 # CONFIGURE LOGGING
@@ -41,8 +53,37 @@ if sys.version_info <= (3, 6, 0):
 ######################################
 # GET THE PARAMETERS FROM THE CONFIG FILE
 # ####################################
-config = configparser.ConfigParser()
-config.read('etc/unicenta2moneybird.conf')
+config = profiles.ReadConfig()
+
+######################################
+# STORE PROFILES
+# ####################################
+
+# With a list of profiles, this process only starts a process per profile, with the same arguments, and waits
+# for them. Every profile process has its own connections, state in var/<profile>/ and metrics.
+profileNames = profiles.GetProfileNames(config)
+if profiles.name is None and len(profileNames) > 0:
+    profile_workers = int(config.get('Global', 'profile_workers', fallback=str(len(profileNames))))
+    if args.daemon:
+        # daemons never finish, so every profile needs a worker of its own
+        profile_workers = len(profileNames)
+    results = profiles.RunProfiles(profileNames, profile_workers, [os.path.abspath(__file__)] + sys.argv[1:])
+    failed = [profile for profile in profileNames if results[profile] != 0]
+    if len(failed) > 0:
+        logger.error("Profiles that failed: {0}".format(', '.join(failed)))
+        exit(1)
+    logger.info("All profiles done!")
+    exit(0)
+
+# the modules read their config when they are imported, so only import them once the profile is known
+from lib import uc, mb, backfill, cache, metrics, scheduler, staging  # noqa: E402
+
+uc.flagVerbose = flagVerbose
+mb.flagVerbose = flagVerbose
+mb.flagNoop = flagNoop
+
+# write the per stage metrics when the run ends, also when it stops early or fails
+atexit.register(metrics.Export)
 
 ######################################
 # PARSING INPUT
@@ -56,7 +97,7 @@ endDate = (date + datetime.timedelta(days=1))
 
 if args.startdatestring is not None:
     try:
-        startDate = datetime.datetime.strptime(args.startdatestring, "%d%m%Y").date()
+        startDate = datetime.datetime.strptime(args.startdatestring, "%d%m%Y")
     except ValueError as err:
         logger.exception("Could not convert '{0}' to date: {1}".format(args.startdatestring, err))
         exit(1)
@@ -66,7 +107,7 @@ if flagVerbose:
 
 if args.enddatestring is not None:
     try:
-        endDate = datetime.datetime.strptime(args.enddatestring, "%d%m%Y").date()
+        endDate = datetime.datetime.strptime(args.enddatestring, "%d%m%Y")
     except ValueError as err:
         logger.exception("Could not convert '{0}' to date: {1}".format(args.enddatestring, err))
         exit(1)
@@ -74,138 +115,334 @@ if args.enddatestring is not None:
 if flagVerbose:
     logger.info("Ending date: {0}".format(endDate))
 
-
 ######################################
-# DOWNLOAD ALL REQUIRED DATA
+# SYNC
 # ####################################
-uc.DownloadTickets()
-uc.DownloadTicketLines()
-uc.DownloadReceipts()
-uc.DownloadPayments()
-uc.DownloadTaxes()
-
-mb.DownloadContacts()
-mb.DownloadFinancialAccounts()
-mb.DownloadLedgerAccounts()
-mb.DownloadTaxRates()
-mb.DownloadFinanancialMutations(startDate, endDate)
-mb.DownloadSalesInvoices(startDate, endDate)
-mb.DownloadPurchaseInvoices(startDate, endDate)
 
-######################################
-# PROCESS SALES (uc receipts)
-# ####################################
 
-uc.TransformSales(startDate, endDate)
-
-sales = uc.GetTransformedSales()
-
-# print(json.dumps(sales, sort_keys=True, indent=2, default=uc.json_serial))
-
-flagMadeChanges = False
-for sale in sales:
-    flagFound = False
-    # vergelijk met de Moneybird facturen
-    for mbFactuur in mb.GetSalesInvoices():
-        if mbFactuur['reference'] == sale['reference']:
-            flagFound = True
-
-    if not flagFound:
-        # Voeg de invoice toe
-        if flagNoop:
-            logger.info("NOOP: Sales invoice with reference '{0}' should be added, but read-only mode is preventing "
-                        "updates".format(sale['reference']))
-        else:
-            date = datetime.datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%S")
-            print(date)
-            print("-------")
-            ucProducts = sale['products']
-            details_attributes = []
-            for ucProduct in ucProducts:
-                products = {"id": ucProduct['number'],
-                            "description": ucProduct['description'],
-                            "price": ucProduct['priceexcl'] * (1 + ucProduct['taxrate']),
-                            "amount": ucProduct['quantity'],
-                            "tax_rate": ucProduct['taxrate']*100
-                            }
-                details_attributes.append(products)
-            new_id = mb.AddSalesInvoice(sale['reference'], date, details_attributes)
-            logger.info("Created sales invoice ({0})".format(sale['reference']))
-            if new_id is not None:
-                mb.SendInvoice(new_id)
-            flagMadeChanges = True
-
-    if flagFound:
-        logger.debug("Sales invoice already exists ({0})".format(sale['reference']))
-# all done, now re-download the purchase invoices from moneybird
-if flagMadeChanges:
-    logger.info("Made changes, so re-downloading the Moneybird purchases")
-    mb.DownloadPurchaseInvoices(startDate, endDate)
+def DownloadData(startDate, endDate, refreshReferenceData=True):
+    """Download the receipts and Moneybird bookings of the window, and the reference data (contacts, accounts and
+       tax rates) when refreshReferenceData is set. The uc extracts and mb fetches are independent, so they all run
+       at the same time.
+    """
+    scheduler.StartPhase("download")
+    tasks = [
+        ("uc tickets", uc.DownloadTickets, (startDate, endDate), "uc_download"),
+        ("uc ticketlines", uc.DownloadTicketLines, (startDate, endDate), "uc_download"),
+        ("uc receipts", uc.DownloadReceipts, (startDate, endDate), "uc_download"),
+        ("uc payments", uc.DownloadPayments, (startDate, endDate), "uc_download"),
+        ("mb financial mutations", mb.DownloadFinanancialMutations, (startDate, endDate), "mb_download"),
+        ("mb sales invoices", mb.DownloadSalesInvoices, (startDate, endDate), "mb_download"),
+        ("mb purchase invoices", mb.DownloadPurchaseInvoices, (startDate, endDate), "mb_download"),
+    ]
+    if refreshReferenceData:
+        tasks.extend([
+            ("uc taxes", uc.DownloadTaxes, (), "uc_download"),
+            ("mb contacts", mb.DownloadContacts, (), "mb_download"),
+            ("mb financial accounts", mb.DownloadFinancialAccounts, (), "mb_download"),
+            ("mb ledger accounts", mb.DownloadLedgerAccounts, (), "mb_download"),
+            ("mb tax rates", mb.DownloadTaxRates, (), "mb_download"),
+        ])
+    scheduler.RunTasks(tasks, download_workers)
+
+    if refreshReferenceData:
+        # look up the ids of the accounts named in the config once, this also fails early when one is missing
+        mb.ResolveConfiguredIds()
+
+
+def Sync(startDate, endDate, refreshReferenceData=True):
+    """Sync the window and return the references of the sales whose invoice could not be created. Their payments
+       are not posted, and the caller must not move the sync mark past them, so the next run tries them again.
+    """
+    DownloadData(startDate, endDate, refreshReferenceData)
+
+    ######################################
+    # PROCESS SALES (uc receipts)
+    # ####################################
+
+    scheduler.StartPhase("transform")
+    uc.TransformSales(startDate, endDate)
+
+    sales = uc.GetTransformedSales()
+
+    # print(json.dumps(sales, sort_keys=True, indent=2, default=uc.json_serial))
+
+    scheduler.StartPhase("invoices")
+    pendingInvoices = []
+    salesInvoicesByReference = mb.GetSalesInvoicesByReference()
+    for sale in sales:
+        # vergelijk met de Moneybird facturen
+        salesInvoice = salesInvoicesByReference.get(sale['reference'])
+        flagFound = salesInvoice is not None
+
+        if not flagFound:
+            # Voeg de invoice toe
+            if flagNoop:
+                logger.info("NOOP: Sales invoice with reference '{0}' should be added, but read-only mode is "
+                            "preventing updates".format(sale['reference']))
+            else:
+                date = datetime.datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%S")
+                ucProducts = sale['products']
+                details_attributes = []
+                for ucProduct in ucProducts:
+                    products = {"id": ucProduct['number'],
+                                "description": ucProduct['description'],
+                                "price": ucProduct['priceexcl'] * (1 + ucProduct['taxrate']),
+                                "amount": ucProduct['quantity'],
+                                "tax_rate": ucProduct['taxrate']*100
+                                }
+                    details_attributes.append(products)
+                pendingInvoices.append((sale['reference'], date, details_attributes, None))
+
+        if flagFound and salesInvoice.get('state') == 'draft':
+            # created by an earlier run whose send failed, it still has to be sent before its payments are linked
+            if flagNoop:
+                logger.info("NOOP: Draft sales invoice with reference '{0}' should be sent, but read-only mode is "
+                            "preventing updates".format(sale['reference']))
+            else:
+                pendingInvoices.append((sale['reference'], None, None, salesInvoice['id']))
+        elif flagFound:
+            logger.debug("Sales invoice already exists ({0})".format(sale['reference']))
+
+    # create and send the new invoices concurrently
+    failedInvoices = set()
+    if len(pendingInvoices) > 0:
+        invoiceResults = mb.AddAndSendSalesInvoices(pendingInvoices)
+        for reference, _, _, draftid in pendingInvoices:
+            result = invoiceResults[reference]
+            if result['error'] is None:
+                if draftid is None:
+                    logger.info("Created sales invoice ({0})".format(reference))
+                else:
+                    logger.info("Sent draft sales invoice ({0})".format(reference))
+            elif result['id'] is not None:
+                logger.error("Could not send sales invoice {0} ({1}), it is left as a draft: {2}".format(
+                    result['id'], reference, result['error']))
+                failedInvoices.add(reference)
+            else:
+                logger.error("Could not create sales invoice ({0}): {1}".format(reference, result['error']))
+                failedInvoices.add(reference)
+
+    # the created invoices were merged into the local store, save it instead of downloading everything again
+    mb.FlushStores()
+
+    ######################################
+    # PROCESS PAYMENTS
+    # ####################################
+
+    scheduler.StartPhase("payments")
+    pendingPayments = []
+    for sale in sales:
+        if sale['reference'] in failedInvoices:
+            logger.warning("Not posting the payments of {0}, its sales invoice could not be created".format(
+                sale['reference']))
+            continue
+        payment_reference = 'betaling van {0}'.format(sale['reference'])
+        payment_date = datetime.datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%S")
+        for payment_number, payment in enumerate(sale['payments']):
+            # every payment of a sale gets its own mutation with the same message, so the n-th payment
+            # exists when there are more than n mutations with that message
+            existingMutations = mb.GetFinancialMutationsByMessage().get(payment_reference, [])
+            flagFinancialMutationFound = len(existingMutations) > payment_number
+
+            if not flagFinancialMutationFound:
+                if flagNoop:
+                    logger.info("NOOP: should create financial statement {0}, but in read-only mode.".format(
+                        payment_reference))
+                else:
+                    pendingPayments.append((payment_reference, payment_date, payment['amount']))
+
+            if flagFinancialMutationFound:
+                logger.debug("Financial statement already exists ({0})".format(payment_reference))
+
+    # post the new payments grouped into a statement per day
+    if len(pendingPayments) > 0:
+        mb.AddFinancialStatementsInBatches(pendingPayments)
+
+    # the created mutations were merged into the local store, save it instead of downloading everything again
+    mb.FlushStores()
+
+    ######################################
+    # PROCESS LINKS
+    ######################################
+
+    # Now we will start the cross-checks to see if stuff needs to be linked.
+
+    scheduler.StartPhase("links")
+    salesInvoicesByReference = mb.GetSalesInvoicesByReference()
+    for fm in mb.GetUnlinkedFinancialMutations():
+        fmreference = str(fm['message'])
+        if fmreference.startswith('betaling van POS verkoop '):
+            # this is one of our UC financial statements, without payments, so we need to start linking!
+            fm_amount = decimal.Decimal(fm['amount'])
+
+            # the message is 'betaling van POS verkoop <ticketid>', the sales invoice has reference
+            # 'POS verkoop <ticketid>'
+            ticketid = fmreference[len('betaling van POS verkoop '):]
+            si = salesInvoicesByReference.get("POS verkoop {0}".format(ticketid))
+            if si is not None:
+                if flagNoop:
+                    logger.info(
+                        "NOOP: should create link for financial mutation {0}, but in read-only mode.".format(
+                            fmreference))
+                else:
+                    mb.LinkSalesInvoice(fm['id'], si['id'], fm_amount)
+                    logger.info("Created link for financial mutation {0}.".format(fmreference))
+            else:
+                logger.info("Could not find a sales invoice for financial statement {0}, ignoring.".format(
+                    fmreference))
 
-######################################
-# PROCESS PAYMENTS
-# ####################################
+    scheduler.EndPhase()
+    return failedInvoices
 
-flagFinancialStatementsChanged = False
 
-for sale in sales:
-    for payment in sale['payments']:
-        payment_reference = 'betaling van {0}'.format(sale['reference'])
-        payment_date = datetime.datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%S")
+def LogStatistics():
+    if flagVerbose:
+        cache.LogStatistics()
+        mb.LogConnectionStatistics()
+        mb.LogThrottleStatistics()
+        staging.LogStatistics()
 
-        flagFinancialMutationFound = False
-        for mbFinancialMutation in mb.GetFinancialMutations():
-            if mbFinancialMutation['message'] == payment_reference:
-                flagFinancialMutationFound = True
 
-        if not flagFinancialMutationFound:
-            if flagNoop:
-                logger.info("NOOP: should create financial statement {0}, but in read-only mode.".format(payment_reference))
-            else:
-                mb.AddFinancialStatementAndMutation(payment_reference, date, payment['amount'])
-                logger.info("Created financial statement ({0})".format(payment_reference))
-                flagFinancialStatementsChanged = True
+def IncrementalStartDate(lastSyncMark):
+    """Start a little before the receipt we synced last, so receipts that were edited late are picked up too"""
+    overlap_minutes = int(config.get('Unicenta', 'sync_overlap_minutes', fallback='60'))
+    return (datetime.datetime.strptime(lastSyncMark['datenew'], "%Y-%m-%dT%H:%M:%S") +
+            datetime.timedelta(minutes=(0 - overlap_minutes)))
+
 
-        if flagFinancialMutationFound:
-            logger.debug("Financial statement already exists ({0})".format(payment_reference))
+download_workers = int(config.get('Global', 'download_workers', fallback='12'))
+
+######################################
+# DAEMON MODE
+# ####################################
 
-if flagFinancialStatementsChanged:
-    logger.info("Financial mutations were changed, re-downloading")
-    mb.DownloadFinanancialMutations(startDate, endDate)
+# The process stays up, so the database connections, the http session and the reference data stay warm. Every
+# poll only looks at the newest receipt, and only syncs when there is a new one. The reference data is downloaded
+# again when it is older than reference_ttl_seconds.
+if args.daemon:
+    poll_seconds = float(config.get('Global', 'daemon_poll_seconds', fallback='30'))
+    reference_ttl_seconds = float(config.get('Global', 'reference_ttl_seconds', fallback='3600'))
+    lastSyncMark = None if args.full or args.startdatestring is not None else uc.GetSyncState()
+    referenceLoaded = None
+    logger.info("Daemon mode, polling every {0:.0f}s".format(poll_seconds))
+    while True:
+        pollStarted = time.time()
+        try:
+            syncMark = uc.GetLatestReceipt()
+            if syncMark is not None and syncMark != lastSyncMark:
+                if lastSyncMark is not None:
+                    startDate = IncrementalStartDate(lastSyncMark)
+                endDate = datetime.datetime.today() + datetime.timedelta(days=1)
+                refreshReferenceData = referenceLoaded is None or pollStarted - referenceLoaded > reference_ttl_seconds
+                logger.info("New receipt {0} at {1}, syncing from {2}".format(syncMark['ticketid'],
+                                                                               syncMark['datenew'], startDate))
+                metrics.Reset()
+                failedInvoices = Sync(startDate, endDate, refreshReferenceData)
+                if refreshReferenceData:
+                    referenceLoaded = pollStarted
+                if len(failedInvoices) > 0:
+                    # keep the old mark, so the next poll syncs these sales again
+                    logger.error("{0} sales invoices failed, retrying at the next poll".format(len(failedInvoices)))
+                else:
+                    if not flagNoop:
+                        uc.SaveSyncState(syncMark)
+                    lastSyncMark = syncMark
+                metrics.succeeded = len(failedInvoices) == 0
+                metrics.Export()
+                LogStatistics()
+        except (Exception, SystemExit) as err:
+            # the api helpers exit on errors, in daemon mode that only ends this poll, the next one tries again
+            logger.exception("Sync failed, retrying at the next poll: {0}".format(err))
+            metrics.succeeded = False
+            metrics.Export()
+        time.sleep(max(0.0, poll_seconds - (time.time() - pollStarted)))
 
 ######################################
-# PROCESS LINKS
+# BACKFILL
+# ####################################
+
+# A long window is synced one partition at a time, so only one partition of receipts and Moneybird records is in
+# memory, and the period filters stay small. Every completed partition is checkpointed in var/, an interrupted
+# backfill resumes after the last one. The reference data is only downloaded for the first partition.
+if args.backfill:
+    if args.startdatestring is None:
+        logger.error("A backfill needs a --startdate")
+        exit(1)
+    if args.full:
+        backfill.ClearCheckpoint()
+    if args.enddatestring is None:
+        # the default end has the time of day in it, a last partition ending there would never match its checkpoint
+        endDate = datetime.datetime(endDate.year, endDate.month, endDate.day)
+    completed = backfill.LoadCheckpoint()
+    partitions = backfill.GetPartitions(startDate, endDate)
+    refreshReferenceData = True
+    failedPartitions = 0
+    for number, partition in enumerate(partitions, start=1):
+        if backfill.PartitionKey(partition) in completed:
+            logger.info("Backfill partition {0}/{1} ({2} - {3}) was already done".format(
+                number, len(partitions), partition[0], partition[1]))
+            continue
+        logger.info("Backfill partition {0}/{1} ({2} - {3})".format(number, len(partitions), partition[0],
+                                                                    partition[1]))
+        metrics.Reset()
+        # the receipt windows exclude both ends, start a second early so a receipt at midnight is not skipped
+        failedInvoices = Sync(partition[0] - datetime.timedelta(seconds=1), partition[1], refreshReferenceData)
+        refreshReferenceData = False
+        if len(failedInvoices) > 0:
+            # not checkpointed, so resuming the backfill syncs this partition again
+            logger.error("Backfill partition {0}/{1}: {2} sales invoices failed".format(number, len(partitions),
+                                                                                     len(failedInvoices)))
+            failedPartitions += 1
+        elif partition[1] > datetime.datetime.now():
+            # the partition of today is not over yet, a resumed backfill syncs it again for the later receipts
+            logger.info("Backfill partition {0}/{1} is still open, not checkpointed".format(number, len(partitions)))
+        elif not flagNoop:
+            completed.add(backfill.PartitionKey(partition))
+            backfill.SaveCheckpoint(completed)
+        metrics.succeeded = len(failedInvoices) == 0
+        metrics.Export()
+        LogStatistics()
+    if failedPartitions > 0:
+        logger.error("Backfill done, {0} of {1} partitions had failed invoices".format(failedPartitions,
+                                                                                    len(partitions)))
+        exit(1)
+    logger.info("Backfill done, {0} partitions".format(len(partitions)))
+    exit(0)
+
 ######################################
+# INCREMENTAL SYNC
+# ####################################
 
-# Now we will start the cross-checks to see if stuff needs to be linked.
-
-for fm in mb.GetFinancialMutations():
-    fmreference = str(fm['message'])
-    if fmreference.startswith('betaling van POS verkoop'):
-        # this is one of our UC financial statements
-        fm_payments = fm['payments']
-        fm_ledger_account_bookings = fm['ledger_account_bookings']
-        fm_amount = decimal.Decimal(fm['amount'])
-
-        if len(fm_payments) == 0:
-            # these are no payments for this financial mutation, so we need to start linking!
-
-            # this is a sales invoice. Find the sales invoice to go with it.
-            flagSalesInvoiceFound = False
-            for si in mb.GetSalesInvoices():
-                sireference = str(si['reference'])
-
-                if sireference in fmreference:
-                    flagSalesInvoiceFound = True
-                    if flagNoop:
-                        logger.info(
-                            "NOOP: should create link for financial mutation {0}, but in read-only mode.".format(
-                                fmreference))
-                    else:
-                        mb.LinkSalesInvoice(fm['id'], si['id'], fm_amount)
-                        logger.info("Created link for financial mutation {0}.".format(fmreference))
-            if not flagSalesInvoiceFound:
-                logger.info("Could not find a sales invoice for financial statement {0}, ignoring.".format(
-                    fmreference))
+# Without an explicit start date, only receipts after the mark of the previous run are processed (plus an
+# overlap for late edits). If the newest receipt is still the one we synced last time, there is nothing to do.
+flagIncremental = not args.full and args.startdatestring is None
+syncMark = uc.GetLatestReceipt()
+if flagIncremental:
+    lastSyncMark = uc.GetSyncState()
+    if lastSyncMark is not None:
+        if lastSyncMark == syncMark:
+            logger.info("No new receipts since receipt {0} at {1}, nothing to do.".format(lastSyncMark['ticketid'],
+                                                                                          lastSyncMark['datenew']))
+            metrics.succeeded = True
+            exit(0)
+        startDate = IncrementalStartDate(lastSyncMark)
+        logger.info("Incremental sync from {0} (last synced receipt {1})".format(startDate, lastSyncMark['ticketid']))
+
+failedInvoices = Sync(startDate, endDate)
+
+if len(failedInvoices) > 0:
+    # do not move the sync mark, the next run has to try these sales again
+    LogStatistics()
+    logger.error("{0} sales invoices could not be created: {1}".format(len(failedInvoices),
+                                                                      ', '.join(sorted(failedInvoices))))
+    exit(1)
+
+if syncMark is not None and not flagNoop:
+    uc.SaveSyncState(syncMark)
+
+metrics.succeeded = True
+
+LogStatistics()
 
 logger.info("All done!")